@@ -1,18 +1,17 @@
-#!/usr/bin/env python2
+#!/usr/bin/env python
 #vim:fileencoding=utf8
 import matplotlib
 matplotlib.rcParams["backend"]="Agg"
 import pylab as pl
 import numpy as np
-from cStringIO import StringIO
 import sixel
 
 def sixelfig():
-    buf = StringIO()
-    pl.savefig(buf)
-    buf.seek(0)
+    # hand the rendered RGBA pixels over as they are, no PNG round trip
+    canvas = pl.gcf().canvas
+    canvas.draw()
     writer = sixel.SixelWriter()
-    writer.draw(buf)
+    writer.draw(np.asarray(canvas.buffer_rgba()))
 
 def main():
     pl.figure(figsize=(4,3))
@@ -24,4 +23,3 @@ def main():
 
 if __name__=="__main__":
     main()
-
@@ -26,10 +26,46 @@ import os
 import sys
 import optparse
 import select
-import logging
 
-from .cellsize import CellSizeDetector
-from .sixel import SixelWriter
+# the public names and their modules. they are imported on first use,
+# so that sixelconv --client sends its request without loading the
+# converter and import sixel does not load asyncio.
+_EXPORTS = {"CellSizeDetector": "cellsize",
+            "TerminalProbe": "probe",
+            "DEFAULT_CELLSIZE": "probe",
+            "get_cellsize": "probe",
+            "SixelWriter": "sixel",
+            "PixelBuffer": "converter",
+            "ConversionStats": "converter",
+            "QuantizeCache": "cache",
+            "SixelPlayer": "animation",
+            "open_frames": "animation",
+            "read_raw_frames": "animation",
+            "SixelImage": "decoder",
+            "decode": "decoder",
+            "verify": "decoder",
+            "AsyncSixelWriter": "aio"}
+
+__all__ = ["main"] + sorted(_EXPORTS)
+
+
+def __getattr__(name):
+    if not name in _EXPORTS:
+        raise AttributeError("module %r has no attribute %r"
+                             % (__name__, name))
+    import importlib
+    module = importlib.import_module("." + _EXPORTS[name], __name__)
+    value = globals()[name] = getattr(module, name)
+    return value
+
+
+if sys.version_info < (3, 7):  # no module __getattr__, import them now
+    for _name in sorted(_EXPORTS):
+        try:
+            __getattr__(_name)
+        except (ImportError, SyntaxError):  # no asyncio before Python 3.5
+            __all__.remove(_name)
+    del _name
 
 license_text = """
 Copyright (C) 2012-2014  Hayaki Saito <user@zuse.jp>
@@ -50,19 +86,16 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
 def _filenize(f):
+    import io
     import stat
 
     mode = os.fstat(f.fileno()).st_mode
     if stat.S_ISFIFO(mode) or os.isatty(f.fileno()):
-        try:
-            from cStringIO import StringIO
-        except ImportError:
-            from StringIO import StringIO
-        return StringIO(f.read())
-    return f
+        return io.BytesIO(getattr(f, "buffer", f).read())
+    return getattr(f, "buffer", f)
 
 
-def main():
+def _create_parser():
 
     parser = optparse.OptionParser()
 
@@ -145,40 +178,233 @@ def main():
                       default=True,
                       help="The size priority mode")
 
+    parser.add_option("-O", "--optimize",
+                      action="store_true",
+                      dest="optimize",
+                      default=False,
+                      help="The smallest output, for slow links")
+
+    parser.add_option("-2", "--two-pass",
+                      action="store_true",
+                      dest="twopass",
+                      default=False,
+                      help="Choose the smaller of the speed and size "
+                           "priority encodings band by band")
+
+    parser.add_option("--max-encode-time",
+                      action="store",
+                      type="float",
+                      dest="max_encode_time",
+                      help="With -2, encode the bands left after this many "
+                           "seconds in the speed priority way")
+
+    parser.add_option("-d", "--dither",
+                      action="store",
+                      type="choice",
+                      choices=["none", "bayer", "floyd-steinberg"],
+                      dest="dither",
+                      help="Dither method, 'none' (default), 'bayer' or "
+                           "'floyd-steinberg'")
+
+    # the quantizers registered by the time the options are parsed,
+    # see sixel.quantizer.register()
+    from .quantizer import QUANTIZERS
+
+    parser.add_option("--quantizer",
+                      action="store",
+                      type="choice",
+                      choices=sorted(QUANTIZERS),
+                      dest="quantizer",
+                      help="Palette selection, 'adaptive' (PIL, default), "
+                           "'median-cut', 'kmeans' or one added with "
+                           "sixel.quantizer.register()")
+
+    parser.add_option("--quantize-sample",
+                      action="store",
+                      type="int",
+                      dest="quantize_sample",
+                      help="Choose the palette from about this many pixels "
+                           "of large images")
+
+    parser.add_option("--resample",
+                      action="store",
+                      type="choice",
+                      choices=["nearest", "box", "bilinear", "hamming",
+                               "bicubic", "lanczos"],
+                      dest="resample",
+                      default="bicubic",
+                      help="Resampling filter for -w/-e, 'nearest', 'box', "
+                           "'bilinear', 'hamming', 'bicubic' (default) or "
+                           "'lanczos'")
+
+    parser.add_option("--fit",
+                      action="store_true",
+                      dest="fit",
+                      default=False,
+                      help="Keep the aspect ratio, fitting within -w/-e or "
+                           "the terminal window")
+
+    parser.add_option("--memory-limit",
+                      action="store",
+                      type="int",
+                      dest="memory_limit",
+                      help="Convert in strips using about this many MiB, "
+                           "for very large images")
+
+    parser.add_option("--monochrome",
+                      action="store_true",
+                      dest="monochrome",
+                      help="Two colors thresholded on luminance, for charts "
+                           "and QR codes (default with -n 2 or less)")
+
+    parser.add_option("-p", "--palette",
+                      action="store",
+                      type="choice",
+                      choices=["web-safe", "xterm-256"],
+                      dest="palette",
+                      help="Use a fixed palette, 'web-safe' or 'xterm-256'")
+
+    parser.add_option("--backend",
+                      action="store",
+                      type="choice",
+                      choices=["python", "numpy"],
+                      dest="backend",
+                      default="python",
+                      help="Body encoder backend, 'python' or 'numpy'")
+
+    parser.add_option("-j", "--jobs",
+                      action="store",
+                      type="int",
+                      dest="jobs",
+                      default=1,
+                      help="Number of parallel encoding jobs, or of files "
+                           "converted at once with several files")
+
+    parser.add_option("--files-from",
+                      action="store",
+                      dest="files_from",
+                      help="Also convert the files listed in this file, one "
+                           "per line ('-' for stdin)")
+
+    parser.add_option("--output-dir",
+                      action="store",
+                      dest="output_dir",
+                      help="Write each image to <name>.six in this "
+                           "directory, under the image's own path, "
+                           "instead of stdout")
+
+    parser.add_option("--cache",
+                      action="store_true",
+                      dest="cache",
+                      default=False,
+                      help="Cache quantized images in ~/.pysixel/cache")
+
+    parser.add_option("--stats",
+                      action="store_true",
+                      dest="stats",
+                      default=False,
+                      help="Print the time spent in each stage to stderr")
+
+    parser.add_option("--verify",
+                      action="store_true",
+                      dest="verify",
+                      default=False,
+                      help="Decode the output and compare it with the "
+                           "converted image, exit with 1 if they differ")
+
     parser.add_option("-v", "--version",
                       action="store_true",
                       dest="version",
                       default=False,
                       help="Show version")
 
-    options, args = parser.parse_args()
+    parser.add_option("--serve",
+                      action="store_true",
+                      dest="serve",
+                      default=False,
+                      help="Run as a conversion server on a Unix socket")
 
-    if options.version:
-        print(license_text)
-        sys.exit(0)
+    parser.add_option("--client",
+                      action="store_true",
+                      dest="client",
+                      default=False,
+                      help="Send the conversion to a running server")
 
-    rcdir = os.path.join(os.getenv("HOME"), ".pysixel")
-    logdir = os.path.join(rcdir, "log")
-    if not os.path.exists(logdir):
-        os.makedirs(logdir)
+    parser.add_option("--socket",
+                      action="store",
+                      dest="socket",
+                      help="Unix socket path of the server (default: ~/.pysixel/sixelconv.sock)")
 
-    logfile = os.path.join(logdir, "log.txt")
-    logging.basicConfig(filename=logfile, filemode="w")
+    return parser
+
+
+def _has_position(options):
+    return (options.left, options.top,
+            options.width, options.height) != (None, None, None, None)
+
+
+def _get_cellsize(stdin, stdout, terminal_probe=None):
+    from .probe import DEFAULT_CELLSIZE, get_cellsize
+
+    if os.isatty(stdout.fileno()) and os.isatty(stdin.fileno()):
+        try:
+            stdout.flush()
+            return get_cellsize(stdin.fileno(), terminal_probe,
+                                stdout.fileno())
+        except Exception:
+            pass
+    return DEFAULT_CELLSIZE
+
+
+def _get_terminal_size(stdout):
+    # (columns, rows) of the terminal, (80, 24) if unknown
+    try:
+        import fcntl
+        import struct
+        import termios
+        rows, columns = struct.unpack("hh", fcntl.ioctl(stdout.fileno(),
+                                                        termios.TIOCGWINSZ,
+                                                        b"\0" * 4))
+        if rows > 0 and columns > 0:
+            return columns, rows
+    except Exception:
+        pass
+    return (int(os.getenv("COLUMNS", 80)), int(os.getenv("LINES", 24)))
+
+
+def _fit_terminal(options, stdout):
+    # --fit without -w/-e fits the image within the terminal window,
+    # leaving a line for the prompt. returns the options added, for the
+    # server to see them too.
+    if not options.fit or options.width or options.height:
+        return []
+    columns, rows = _get_terminal_size(stdout)
+    options.width = str(columns)
+    options.height = str(max(1, rows - 1))
+    return ["-w", options.width, "-e", options.height]
+
+
+def _open_image(args, stdin):
+    if select.select([stdin, ], [], [], 0.0)[0]:
+        return _filenize(stdin)
+    elif len(args) == 0 or args[0] == '-':
+        return _filenize(stdin)
+    return args[0]
+
+
+def _draw(options, imagefile, output, cellsize, cache=None, stats=None):
+    # returns the sixel.decoder.VerifyResult with --verify, else None
+    from .sixel import SixelWriter
+    from .converter import ConversionStats
+    from .decoder import verify
 
-    stdin, stdout = sys.stdin, sys.stdout
     left = options.left
     top = options.top
     width = options.width
     height = options.height
 
-    if (left, top, width, height) != (None, None, None, None):
-        if os.isatty(stdout.fileno()) and os.isatty(stdin.fileno()):
-            try:
-                char_width, char_height = CellSizeDetector().get_size()
-            except Exception:
-                char_width, char_height = (10, 20)
-        else:
-            char_width, char_height = (10, 20)
+    if _has_position(options):
+        char_width, char_height = cellsize
 
         if not left is None:
             pos = left.find("px")
@@ -209,27 +435,176 @@ def main():
                 height = int(height) * char_height
 
     writer = SixelWriter(f8bit=options.f8bit,
-                         bodyonly=options.bodyonly)
+                         bodyonly=options.bodyonly,
+                         palette=options.palette)
+
+    # stats given by the caller are left to it
+    report = stats is None and options.stats
+    if report:
+        stats = ConversionStats()
+
+    memory_limit = options.memory_limit
+    if memory_limit:
+        memory_limit <<= 20  # MiB
+
+    converter = writer.draw(imagefile,
+                            output=output,
+                            absolute=options.fabsolute,
+                            x=left,
+                            y=top,
+                            w=width,
+                            h=height,
+                            ncolor=int(options.ncolor),
+                            alphathreshold=options.alphathreshold,
+                            chromakey=options.chromakey,
+                            fast=options.fast,
+                            backend=options.backend,
+                            workers=options.jobs,
+                            cache=cache,
+                            stats=stats,
+                            optimize=options.optimize,
+                            dither=options.dither,
+                            quantizer=options.quantizer,
+                            quantize_sample=options.quantize_sample,
+                            resample=options.resample,
+                            fit=options.fit,
+                            memory_limit=memory_limit,
+                            monochrome=options.monochrome,
+                            twopass=options.twopass,
+                            max_encode_time=options.max_encode_time)
+
+    if report:
+        sys.stderr.write("%s\n" % stats)
+
+    if options.verify:
+        return verify(converter)
+    return None
 
-    try:
-        if select.select([stdin, ], [], [], 0.0)[0]:
-            imagefile = _filenize(stdin)
-        elif len(args) == 0 or args[0] == '-':
-            imagefile = _filenize(stdin)
+
+def main():
+
+    parser = _create_parser()
+    options, args = parser.parse_args()
+
+    if options.version:
+        print(license_text)
+        sys.exit(0)
+
+    rcdir = os.path.join(os.getenv("HOME"), ".pysixel")
+    logdir = os.path.join(rcdir, "log")
+    if not os.path.exists(logdir):
+        os.makedirs(logdir)
+
+    socket_path = options.socket
+    if socket_path is None:
+        socket_path = os.path.join(rcdir, "sixelconv.sock")
+
+    stdin, stdout = sys.stdin, sys.stdout
+
+    if not options.serve:
+        if options.verify and (options.client or options.memory_limit):
+            parser.error("--verify needs the whole image in this process, "
+                         "not --client or --memory-limit")
+
+        argv = sys.argv[1:] + _fit_terminal(options, stdout)
+
+        # several files, a pattern, a list of files or an output
+        # directory: batch mode
+        from . import batch
+
+        names = batch.expand(args)
+        batch_mode = names != args or len(names) > 1 \
+            or options.files_from or options.output_dir
+        if batch_mode:
+            if options.files_from == "-":
+                names += batch.read_list(stdin)
+            elif options.files_from:
+                f = open(options.files_from)
+                try:
+                    names += batch.read_list(f)
+                finally:
+                    f.close()
+
+        if _has_position(options):
+            from .probe import TerminalProbe
+
+            # what the terminal answered is kept for later runs
+            terminal_probe = TerminalProbe(os.path.join(rcdir,
+                                                        "terminal.json"))
+            cellsize = _get_cellsize(stdin, stdout, terminal_probe)
         else:
-            imagefile = args[0]
-
-        writer.draw(imagefile,
-                    output=sys.stdout,
-                    absolute=options.fabsolute,
-                    x=left,
-                    y=top,
-                    w=width,
-                    h=height,
-                    ncolor=int(options.ncolor),
-                    alphathreshold=options.alphathreshold,
-                    chromakey=options.chromakey,
-                    fast=options.fast)
+            cellsize = None
+
+        if options.client and not batch_mode:
+            # the server does the rest, nothing else is loaded here
+            from .server import request
+
+            try:
+                request(socket_path,
+                        argv,
+                        _open_image(args, stdin),
+                        stdout,
+                        cellsize)
+            except KeyboardInterrupt:
+                pass
+            return
+
+    import logging
+    from .cache import QuantizeCache
+
+    logfile = os.path.join(logdir, "log.txt")
+    logging.basicConfig(filename=logfile, filemode="w")
+
+    if options.cache:
+        cache = QuantizeCache(directory=os.path.join(rcdir, "cache"))
+    else:
+        cache = None
+
+    if options.serve:
+        from .server import serve
+        from .converter import ConversionStats
+
+        if cache is None:
+            cache = QuantizeCache()
+
+        def convert(argv, imagefile, output, cellsize):
+            # optparse keeps its state on the parser, so each request
+            # gets its own. returns the --stats report for the client.
+            options, args = _create_parser().parse_args(argv)
+            stats = None
+            if options.stats:
+                stats = ConversionStats()
+            _draw(options, imagefile, output, cellsize, cache, stats)
+            if stats is not None:
+                return "%s" % stats
+            return None
+
+        try:
+            serve(socket_path, convert)
+        except KeyboardInterrupt:
+            pass
+        return
+
+    try:
+        if batch_mode:
+            stats = batch.run(options,
+                              names,
+                              stdout,
+                              cellsize,
+                              jobs=options.jobs,
+                              directory=options.output_dir,
+                              cache=cache)
+            sys.stderr.write("%s\n" % stats)
+            if stats.failed:
+                sys.exit(1)
+            return
+
+        imagefile = _open_image(args, stdin)
+        result = _draw(options, imagefile, stdout, cellsize, cache)
+        if result is not None:
+            sys.stderr.write("%s\n" % result)
+            if not result:
+                sys.exit(1)
     except KeyboardInterrupt:
         pass
 
@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# ***** BEGIN LICENSE BLOCK *****
+# Copyright (C) 2012-2014  Hayaki Saito <user@zuse.jp>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# ***** END LICENSE BLOCK *****
+
+#
+# asyncio support (Python 3.5 or later).
+#
+# Images are converted and encoded in an executor and written to an
+# asyncio StreamWriter chunk by chunk, waiting for it to drain, so a
+# slow terminal holds back the encoder instead of filling memory and
+# the event loop never waits on either.
+#
+
+import os
+import asyncio
+import functools
+
+from . import probe
+from .sixel import SixelWriter, SixelConverter, converter_options
+from .converter import BLOCKSIZE
+
+
+def _get_loop():
+    try:
+        return asyncio.get_running_loop()
+    except AttributeError:  # Python < 3.7
+        return asyncio.get_event_loop()
+
+
+class _Escapes:
+
+    # collects the cursor movements of a SixelWriter
+
+    def __init__(self, isatty):
+        self._parts = []
+        self._isatty = isatty
+
+    def write(self, s):
+        self._parts.append(s)
+
+    def isatty(self):
+        return self._isatty
+
+    def getvalue(self):
+        s = ''.join(self._parts)
+        self._parts = []
+        return s
+
+
+async def probe_terminal(fd=None, timeout=0.5):
+    # sixel.probe.query() with the replies read by the event loop.
+    # returns the replies to probe.QUERIES from the terminal on fd,
+    # /dev/tty by default.
+    loop = _get_loop()
+    opened = fd is None
+    if opened:
+        fd = os.open("/dev/tty", os.O_RDWR | os.O_NOCTTY)
+    try:
+        parser = probe.ReplyParser()
+        done = loop.create_future()
+
+        def readable():
+            try:
+                data = os.read(fd, 1024)
+            except OSError:
+                data = b''
+            if (parser.feed(data) or not data) and not done.done():
+                done.set_result(None)
+
+        backup = probe.set_raw(fd)
+        loop.add_reader(fd, readable)
+        try:
+            os.write(fd, probe.QUERIES)
+            await asyncio.wait_for(done, timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            loop.remove_reader(fd)
+            probe.restore(fd, backup)
+    finally:
+        if opened:
+            os.close(fd)
+    return parser.reports
+
+
+class AsyncSixelWriter:
+
+    # SixelWriter for asyncio programs. a frame can be cancelled while it
+    # is drawn, the image is then ended where it is so that the terminal
+    # leaves sixel mode.
+
+    def __init__(self,
+                 f8bit=False,
+                 bodyonly=False,
+                 palette=None,
+                 executor=None,
+                 isatty=None,
+                 terminal_probe=None):
+        # executor: where images are converted, the loop's default one
+        # when None. isatty: whether the cursor is saved and restored
+        # around images, by default when the stream is a tty.
+        # terminal_probe: a sixel.probe.TerminalProbe caching what the
+        # terminal answers, by default one kept in memory. its entries
+        # are stale once the window size differs, see watch_resize() to
+        # also drop them on SIGWINCH.
+        self._writer = SixelWriter(f8bit, bodyonly, palette)
+        self.f8bit = f8bit
+        self._executor = executor
+        self._isatty = isatty
+        self._task = None
+        self._watching = None
+        if terminal_probe is None:
+            terminal_probe = probe.TerminalProbe()
+        self._probe = terminal_probe
+
+    def reset_palette(self):
+        self._writer.reset_palette()
+
+    def __is_tty(self, stream):
+        if self._isatty is not None:
+            return self._isatty
+        pipe = stream.get_extra_info("pipe")
+        try:
+            return pipe.isatty()
+        except Exception:
+            return False
+
+    def __write(self, stream, s):
+        if s:
+            stream.write(s.encode('latin-1'))
+
+    async def draw(self,
+                   image,
+                   stream,
+                   absolute=False,
+                   x=None,
+                   y=None,
+                   blocksize=BLOCKSIZE,
+                   **kwargs):
+        # image and kwargs are those of SixelWriter.draw(), stream is an
+        # asyncio StreamWriter. returns the converter.
+        loop = _get_loop()
+        writer = self._writer
+        escapes = _Escapes(self.__is_tty(stream))
+
+        try:
+            image.seek(0)
+        except Exception:
+            pass
+        if writer._palette is not None:
+            kwargs["palette"] = writer._palette
+            kwargs["define_palette"] = not writer._palette_defined
+        sixel_converter = await loop.run_in_executor(
+            self._executor,
+            functools.partial(SixelConverter, image, self.f8bit,
+                              **converter_options(kwargs)))
+
+        writer.save_position(escapes)
+        if not x is None:
+            writer.move_x(x, absolute, escapes)
+        if not y is None:
+            writer.move_y(y, absolute, escapes)
+        self.__write(stream, escapes.getvalue())
+
+        # the next chunk is encoded while the previous one drains
+        chunks = sixel_converter.iter_chunks(writer._bodyonly, blocksize)
+        started = complete = False
+        try:
+            pending = loop.run_in_executor(self._executor, next, chunks, None)
+            while True:
+                chunk = await pending
+                if chunk is None:
+                    break
+                pending = loop.run_in_executor(self._executor,
+                                               next, chunks, None)
+                stream.write(chunk)
+                started = True
+                await stream.drain()
+            complete = True
+        finally:
+            if started and not complete and not writer._bodyonly:
+                self.__write(stream, sixel_converter.ST)
+            writer.restore_position(escapes)
+            self.__write(stream, escapes.getvalue())
+        if writer._palette is not None:
+            writer._palette_defined = True
+        return sixel_converter
+
+    async def __draw_after(self, previous, image, stream, kwargs):
+        # the cancelled frame ends its image before this one starts
+        if previous is not None:
+            await asyncio.wait([previous])
+        return await self.draw(image, stream, **kwargs)
+
+    async def draw_latest(self, image, stream, **kwargs):
+        # draws image in place of the frame still being drawn by an
+        # earlier call, which is cancelled. returns the converter, or
+        # None when this frame has been replaced by a newer one.
+        previous = self._task
+        if previous is not None and not previous.done():
+            previous.cancel()
+        task = asyncio.ensure_future(self.__draw_after(previous, image,
+                                                       stream, kwargs))
+        self._task = task
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if task.cancelled():
+                return None
+            task.cancel()
+            raise
+
+    async def get_terminal_info(self, fd=None, timeout=0.5):
+        # sixel.probe.TerminalInfo of the terminal on fd (/dev/tty by
+        # default), from the cache when it is fresh
+        opened = fd is None
+        if opened:
+            fd = os.open("/dev/tty", os.O_RDWR | os.O_NOCTTY)
+        try:
+            info = self._probe.lookup(fd)
+            if info is None:
+                reports = await probe_terminal(fd, timeout)
+                info = self._probe.update(fd, reports)
+        finally:
+            if opened:
+                os.close(fd)
+        return info
+
+    async def get_cellsize(self, fd=None, timeout=0.5):
+        # (width, height) of a cell in pixels, probe.DEFAULT_CELLSIZE when
+        # the terminal does not tell
+        info = await self.get_terminal_info(fd, timeout)
+        return info.cellsize or probe.DEFAULT_CELLSIZE
+
+    def reset_cellsize(self):
+        # ask the terminal again, e.g. after its font has changed
+        self._probe.invalidate()
+
+    def watch_resize(self):
+        # drops the terminal information on SIGWINCH, with a handler of
+        # the running loop, until unwatch_resize(). the loop has one
+        # handler per signal, this replaces any other SIGWINCH handler
+        # of the loop. returns False where signals cannot be watched.
+        import signal
+
+        if self._watching is not None:
+            return True
+        if not hasattr(signal, "SIGWINCH"):
+            return False
+        loop = _get_loop()
+        try:
+            loop.add_signal_handler(signal.SIGWINCH, self._probe.invalidate)
+        except (NotImplementedError, RuntimeError, ValueError):
+            return False
+        self._watching = loop
+        return True
+
+    def unwatch_resize(self):
+        import signal
+
+        if self._watching is not None:
+            self._watching.remove_signal_handler(signal.SIGWINCH)
+            self._watching = None
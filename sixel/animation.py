@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# ***** BEGIN LICENSE BLOCK *****
+# Copyright (C) 2012-2014  Hayaki Saito <user@zuse.jp>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# ***** END LICENSE BLOCK *****
+
+import sys
+import time
+
+from .sixel import SixelWriter, SixelConverter, converter_options
+
+
+def open_frames(file):
+    # frames of a multi-frame image (GIF, APNG, ...), the display
+    # duration in milliseconds is kept in frame.info["duration"]
+    from PIL import Image, ImageSequence
+
+    image = Image.open(file)
+    for frame in ImageSequence.Iterator(image):
+        rgb = frame.convert("RGB")
+        rgb.info["duration"] = frame.info.get("duration")
+        yield rgb
+
+
+def read_raw_frames(f, width, height, mode="RGB"):
+    # fixed-size raw frames from a pipe, until end of file
+    from PIL import Image
+
+    f = getattr(f, "buffer", f)
+    size = width * height * len(mode)
+    while True:
+        data = f.read(size)
+        while data and len(data) < size:
+            chunk = f.read(size - len(data))
+            if not chunk:
+                break
+            data += chunk
+        if len(data) < size:
+            break
+        yield Image.frombytes(mode, (width, height), data)
+
+
+class PlaybackStats:
+
+    def __init__(self):
+        self.frames = 0      # frames read from the source
+        self.sent = 0        # frames written to the output
+        self.unchanged = 0   # frames identical to the one on the screen
+        self.dropped = 0     # frames skipped to keep up with the frame rate
+        self.late = 0        # frames finished after the next one was due
+        self.bands = 0       # bands encoded and written
+        self.total_bands = 0  # bands of all the frames that were not dropped
+        self.bytes = 0       # characters written
+        self.encode_time = 0.0
+        self.elapsed = 0.0
+
+    def fps(self):
+        if self.elapsed > 0:
+            return self.sent / self.elapsed
+        return 0.0
+
+    def __str__(self):
+        return ("frames: %d, sent: %d, unchanged: %d, dropped: %d, "
+                "late: %d, bands: %d/%d, bytes: %d, encode: %.3fs, "
+                "elapsed: %.3fs, fps: %.2f"
+                % (self.frames, self.sent, self.unchanged, self.dropped,
+                   self.late, self.bands, self.total_bands, self.bytes,
+                   self.encode_time, self.elapsed, self.fps()))
+
+
+class SixelPlayer:
+
+    # plays a sequence of frames at the same place on the screen.
+    # the palette of the first frame is used for the whole animation,
+    # so frames can be compared by palette index and only the bands
+    # that differ from the frame on the screen are sent.
+
+    def __init__(self,
+                 writer=None,
+                 output=sys.stdout,
+                 fps=None,
+                 absolute=False,
+                 x=None,
+                 y=None,
+                 w=None,
+                 h=None,
+                 ncolor=256,
+                 fast=True,
+                 backend="python"):
+        if writer is None:
+            writer = SixelWriter()
+        self._writer = writer
+        self._output = output
+        self._fps = fps
+        self._absolute = absolute
+        self._x = x
+        self._y = y
+        self._w = w
+        self._h = h
+        self._ncolor = min(ncolor, 256)
+        self._fast = fast
+        self._backend = backend
+
+    def __interval(self, frame):
+        if self._fps:
+            return 1.0 / self._fps
+        duration = frame.info.get("duration")
+        if duration:
+            return duration / 1000.0
+        return 0.1
+
+    def __quantize(self, image, palette_image):
+        from PIL import Image
+
+        image = image.convert("RGB")
+        if self._w or self._h:
+            width, height = image.size
+            image = image.resize((self._w or width, self._h or height))
+        if palette_image is None:
+            return image.convert("P",
+                                 palette=Image.ADAPTIVE,
+                                 colors=self._ncolor)
+        # error diffusion would spread changes into untouched bands
+        return image.quantize(palette=palette_image,
+                              dither=getattr(Image, "Dither", Image).NONE)
+
+    def __write_frame(self, image, bands):
+        writer = self._writer
+        output = self._output
+        options = converter_options({"ncolor": self._ncolor,
+                                     "fast": self._fast,
+                                     "backend": self._backend})
+        converter = SixelConverter(image, writer.f8bit, **options)
+        text = ''.join(converter.iter_bands(bodyonly=writer._bodyonly,
+                                            bands=bands))
+        writer.save_position(output)
+        try:
+            if not self._x is None:
+                writer.move_x(self._x, self._absolute, output)
+            if not self._y is None:
+                writer.move_y(self._y, self._absolute, output)
+            output.write(text)
+        finally:
+            writer.restore_position(output)
+        output.flush()
+        return len(text)
+
+    def play(self, frames):
+        # frames: PIL images or HxWx3 NumPy arrays. returns PlaybackStats
+        stats = PlaybackStats()
+        palette_image = None
+        screen = None  # bands of the frame on the screen
+        start = time.time()
+        frames = iter(frames)
+        # due: when the frame is to be shown. time spent waiting for a
+        # source slower than the frame rate moves it on, only time spent
+        # here puts the player behind.
+        due = [start]
+
+        def fetch():
+            before = time.time()
+            frame = next(frames, None)
+            now = time.time()
+            if now > due[0]:
+                due[0] += now - max(before, due[0])
+            return frame
+
+        frame = fetch()
+
+        while frame is not None:
+            if not hasattr(frame, "convert"):
+                from PIL import Image
+                frame = Image.fromarray(frame)
+            stats.frames += 1
+            interval = self.__interval(frame)
+
+            # behind by a whole frame: the frame is dropped when a newer
+            # one is ready, the last frame is always drawn. the next
+            # frame is compared with the one still on the screen.
+            if screen is not None and time.time() > due[0] + interval:
+                due[0] += interval
+                following = fetch()
+                if following is not None:
+                    stats.dropped += 1
+                    frame = following
+                    continue
+                due[0] -= interval
+
+            begin = time.time()
+            image = self.__quantize(frame, palette_image)
+            if palette_image is None:
+                palette_image = image
+
+            width = image.size[0]
+            data = image.tobytes()
+            step = width * 6
+            bands = [data[i:i + step] for i in range(0, len(data), step)]
+            if screen is None or len(screen) != len(bands) \
+                    or len(screen[-1]) != len(bands[-1]):
+                changed = None
+            else:
+                changed = [n for n in range(len(bands))
+                           if bands[n] != screen[n]]
+            screen = bands
+            stats.total_bands += len(bands)
+
+            if changed == []:
+                stats.unchanged += 1
+            else:
+                stats.bytes += self.__write_frame(image, changed)
+                stats.sent += 1
+                if changed is None:
+                    stats.bands += len(bands)
+                else:
+                    stats.bands += len(changed)
+            stats.encode_time += time.time() - begin
+
+            now = time.time()
+            if now > due[0] + interval:
+                stats.late += 1
+            due[0] += interval
+            if due[0] > now:
+                time.sleep(due[0] - now)
+            frame = fetch()
+
+        stats.elapsed = time.time() - start
+        return stats
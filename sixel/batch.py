@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# ***** BEGIN LICENSE BLOCK *****
+# Copyright (C) 2012-2014  Hayaki Saito <user@zuse.jp>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# ***** END LICENSE BLOCK *****
+
+#
+# Batch conversion for sixelconv.
+#
+# Each file is converted as a whole (decode, quantize, encode) by one of
+# a pool of worker processes, a few files ahead of the one being written,
+# so the stages of different files overlap. Results are written in input
+# order, to the output or to a .six file per input, named after the
+# whole input path so that inputs never share an output file.
+#
+
+import os
+import sys
+import glob
+import time
+import collections
+
+# the cache of each worker process
+_cache = None
+
+
+class BatchStats:
+
+    def __init__(self):
+        self.files = 0    # files converted
+        self.failed = 0   # files that could not be converted
+        self.pixels = 0   # pixels of the converted images
+        self.bytes = 0    # characters written
+        self.elapsed = 0.0
+
+    def __str__(self):
+        elapsed = self.elapsed or 1e-9
+        return ("files: %d, failed: %d, pixels: %d, bytes: %d, "
+                "elapsed: %.3fs, %.2f files/s, %.2f Mpixels/s, %.2f MB/s"
+                % (self.files, self.failed, self.pixels, self.bytes,
+                   self.elapsed, self.files / elapsed,
+                   self.pixels / elapsed / 1e6, self.bytes / elapsed / 1e6))
+
+
+class _Buffer:
+
+    # output of one conversion, not a tty, so the cursor is left where
+    # the image ends and images follow each other
+
+    def __init__(self):
+        self._parts = []
+
+    def write(self, s):
+        self._parts.append(s)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+    def getvalue(self):
+        return ''.join(self._parts)
+
+
+def expand(args):
+    # file names, with the patterns the shell has left alone expanded
+    names = []
+    for arg in args:
+        if glob.has_magic(arg) and not os.path.exists(arg):
+            matches = sorted(glob.glob(arg))
+            if matches:
+                names.extend(matches)
+                continue
+        names.append(arg)
+    return names
+
+
+def read_list(f):
+    # file names from f, one per line
+    names = []
+    for line in f:
+        line = line.rstrip("\r\n")
+        if line:
+            names.append(line)
+    return names
+
+
+def output_path(directory, name):
+    # name with ".six" added, under its own directories relative to
+    # directory. absolute names and ".." stay within directory.
+    path = os.path.splitdrive(os.path.normpath(name))[1]
+    parts = [part for part in path.replace(os.sep, "/").split("/")
+             if part not in ("", ".", "..")]
+    return os.path.join(directory, *parts) + ".six"
+
+
+def _targets(names, directory):
+    # {name: output path}, and the names whose output path is already
+    # taken by an earlier name, e.g. "../x.png" and "x.png"
+    targets = {}
+    owners = {}
+    collisions = []
+    for name in names:
+        path = output_path(directory, name)
+        owner = owners.setdefault(path, name)
+        if owner != name:
+            collisions.append((name, owner))
+        targets[name] = path
+    return targets, collisions
+
+
+def _init_worker(cache_directory):
+    global _cache
+    from .cache import QuantizeCache
+
+    if cache_directory is not None:
+        _cache = QuantizeCache(directory=cache_directory)
+
+
+def convert(options, name, cellsize, cache=None):
+    # returns (text, pixels) of the file name converted with options
+    from . import _draw
+    from .converter import ConversionStats
+
+    if cache is None:
+        cache = _cache
+    output = _Buffer()
+    stats = ConversionStats()
+    result = _draw(options, name, output, cellsize, cache, stats)
+    # with --verify, an image that does not decode to itself fails
+    if result is not None and not result:
+        raise ValueError(str(result))
+    return output.getvalue(), stats.pixels()
+
+
+def _iter_results(options, names, cellsize, jobs, cache):
+    # yields (name, (text, pixels), error) in the order of names, with
+    # up to twice as many files in flight as there are workers
+    if jobs <= 1:
+        for name in names:
+            try:
+                yield name, convert(options, name, cellsize, cache), None
+            except Exception as e:
+                yield name, None, e
+        return
+
+    import concurrent.futures
+
+    cache_directory = cache and cache._directory
+    executor = concurrent.futures.ProcessPoolExecutor(
+        jobs,
+        initializer=_init_worker,
+        initargs=(cache_directory,))
+    pending = collections.deque()
+
+    def result():
+        name, future = pending.popleft()
+        try:
+            return name, future.result(), None
+        except Exception as e:
+            return name, None, e
+
+    try:
+        for name in names:
+            pending.append((name, executor.submit(convert, options, name,
+                                                  cellsize)))
+            if len(pending) >= jobs * 2:
+                yield result()
+        while pending:
+            yield result()
+    finally:
+        for name, future in pending:
+            future.cancel()
+        executor.shutdown()
+
+
+def run(options, names, output, cellsize=None, jobs=1, directory=None,
+        cache=None):
+    # converts the files names, writing them to output or to .six files
+    # in directory. returns BatchStats.
+    stats = BatchStats()
+    start = time.time()
+    if directory is not None:
+        targets, collisions = _targets(names, directory)
+        for name, owner in collisions:
+            stats.failed += 1
+            sys.stderr.write("sixelconv: %s: output %s is also that of %s\n"
+                             % (name, targets[name], owner))
+        skipped = set([name for name, owner in collisions])
+        names = [name for name in names if not name in skipped]
+    # files are converted in parallel, not their bands
+    options.jobs = 1
+    for name, result, error in _iter_results(options, names, cellsize,
+                                             jobs, cache):
+        if error is not None:
+            stats.failed += 1
+            sys.stderr.write("sixelconv: %s: %s\n" % (name, error))
+            continue
+        text, pixels = result
+        if directory is None:
+            output.write(text)
+            output.flush()
+        else:
+            path = targets[name]
+            parent = os.path.dirname(path)
+            if not os.path.isdir(parent):
+                os.makedirs(parent)
+            # 8-bit controls are single bytes, as in iter_chunks()
+            f = open(path, "wb")
+            try:
+                f.write(text.encode('latin-1'))
+            finally:
+                f.close()
+        stats.files += 1
+        stats.pixels += pixels
+        stats.bytes += len(text)
+    stats.elapsed = time.time() - start
+    return stats
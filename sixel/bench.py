@@ -0,0 +1,485 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# ***** BEGIN LICENSE BLOCK *****
+# Copyright (C) 2012-2014  Hayaki Saito <user@zuse.jp>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# ***** END LICENSE BLOCK *****
+
+#
+# Benchmark suite, run with "python -m sixel.bench".
+#
+# Synthetic images of several kinds and sizes are encoded to PNG, then
+# every stage of a conversion is timed on its own: PNG decode, quantize
+# (the SixelConverter constructor), resize (the resize of a converter
+# asked for half the size, before it quantizes), body encoding and output
+# to /dev/null. Each case keeps the best of --repeat runs and is run in a
+# child process where fork() is available, so that the peak RSS reported
+# is its own. Results can be saved as JSON and compared with an earlier
+# run. With --verify, the output of every case is decoded again and
+# compared with the quantized image. Two-pass cases are also encoded in
+# the speed and size priority modes, and their output compared with the
+# smaller of the two.
+#
+
+import io
+import os
+import sys
+import json
+import time
+import optparse
+import platform
+
+from .converter import SixelConverter as PythonConverter, ConversionStats
+
+KINDS = ["photo", "chart", "noise", "alpha"]
+MODES = {
+    "fast": {},
+    "size": {"fast": False},
+    "optimize": {"optimize": True},
+    "median-cut": {"quantizer": "median-cut"},
+    "kmeans": {"quantizer": "kmeans"},
+    "sampled": {"quantize_sample": 100000},
+    "alpha": {"alphathreshold": 128},
+    "chromakey": {"chromakey": True},
+    "strips": {"memory_limit": 16 << 20},
+    "monochrome": {"monochrome": True},
+    "twopass": {"twopass": True},
+}
+BACKENDS = ["python", "numpy", "cimpl"]
+STAGES = ["decode", "quantize", "resize", "encode", "output"]
+
+
+def generate(kind, width, height):
+    # deterministic synthetic images, "alpha" is RGBA
+    from PIL import Image, ImageDraw
+
+    if kind == "photo":
+        # smooth gradients with a little grain
+        r = Image.linear_gradient("L").resize((width, height))
+        g = Image.radial_gradient("L").resize((width, height))
+        b = r.transpose(Image.FLIP_LEFT_RIGHT)
+        grain = Image.effect_noise((width, height), 12)
+        return Image.merge("RGB", (Image.blend(r, grain, 0.15), g,
+                                   Image.blend(b, grain, 0.15)))
+    if kind == "chart":
+        # flat areas, bars and thin lines, few colors
+        image = Image.new("RGB", (width, height), (255, 255, 255))
+        draw = ImageDraw.Draw(image)
+        colors = [(31, 119, 180), (255, 127, 14), (44, 160, 44),
+                  (214, 39, 40), (148, 103, 189)]
+        bars = 12
+        for i in range(bars):
+            x0 = width * i // bars + 2
+            x1 = width * (i + 1) // bars - 2
+            top = height - height * ((i * 7) % 10 + 1) // 11
+            draw.rectangle((x0, top, x1, height - 1), fill=colors[i % 5])
+        for y in range(0, height, max(1, height // 10)):
+            draw.line((0, y, width, y), fill=(200, 200, 200))
+        return image
+    if kind == "noise":
+        try:
+            import numpy
+        except ImportError:
+            return Image.merge("RGB", [Image.effect_noise((width, height), 128)
+                                       for i in range(3)])
+        state = numpy.random.RandomState(0)
+        pixels = state.randint(0, 256, (height, width, 3)).astype(numpy.uint8)
+        return Image.fromarray(pixels)
+    if kind == "alpha":
+        # a photo with transparent stripes and soft edges
+        image = generate("photo", width, height).convert("RGBA")
+        alpha = Image.linear_gradient("L").rotate(90).resize((width, height))
+        alpha = alpha.point(lambda v: 0 if (v // 32) % 2 else 255)
+        image.putalpha(alpha)
+        return image
+    raise ValueError("unknown image kind: %s" % kind)
+
+
+def get_converter(backend):
+    # returns (converter class, extra keyword arguments), or None when the
+    # backend is not available here
+    if backend == "cimpl":
+        try:
+            from sixel_cimpl import SixelConverter
+        except ImportError:
+            return None
+        return SixelConverter, {}
+    if backend == "numpy":
+        try:
+            import numpy
+        except ImportError:
+            return None
+    return PythonConverter, {"backend": backend}
+
+
+def peak_rss():
+    # peak resident set size of this process in KiB, None if unknown
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        rss //= 1024
+    return rss
+
+
+def run_isolated(function, *args):
+    # function(*args) run in a child process, its result passed back as
+    # JSON. without fork() it runs here.
+    if not hasattr(os, "fork"):
+        return function(*args)
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        status = 1
+        try:
+            os.close(read)
+            data = json.dumps(function(*args)).encode("utf-8")
+            while data:
+                data = data[os.write(write, data):]
+            status = 0
+        except BaseException:
+            import traceback
+            traceback.print_exc()
+        finally:
+            os._exit(status)
+    os.close(write)
+    chunks = []
+    while True:
+        chunk = os.read(read, 65536)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    os.close(read)
+    os.waitpid(pid, 0)
+    if not chunks:
+        raise RuntimeError("benchmark case failed")
+    return json.loads(b"".join(chunks).decode("utf-8"))
+
+
+def _best(function, repeat):
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        result = function()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+
+def run_case(png, kind, size, ncolor, backend, mode, repeat=3,
+             verify=False):
+    from PIL import Image
+
+    converter, kwargs = get_converter(backend)
+    kwargs = dict(kwargs)
+    kwargs.update(MODES[mode])
+    kwargs["ncolor"] = ncolor
+    width, height = size
+    timings = {}
+
+    def decode():
+        image = Image.open(io.BytesIO(png))
+        image.load()
+        return image
+    timings["decode"], image = _best(decode, repeat)
+
+    timings["quantize"], sixel_converter = \
+        _best(lambda: converter(image, **kwargs), repeat)
+
+    quantized = sixel_converter._image
+    if quantized is None:
+        # strips are resized while they are encoded
+        timings["resize"] = 0.0
+    else:
+        def resize():
+            stats = ConversionStats()
+            converter(image, w=max(1, width // 2), h=max(1, height // 2),
+                      stats=stats, **kwargs)
+            return stats.timings["resize"]
+        timings["resize"] = min([resize() for i in range(repeat)])
+
+    timings["encode"], text = \
+        _best(lambda: ''.join(sixel_converter.iter_bands()), repeat)
+
+    devnull = io.open(os.devnull, "w", encoding="latin-1")
+    try:
+        timings["output"], _ = _best(lambda: devnull.write(text), repeat)
+    finally:
+        devnull.close()
+
+    # mismatching pixels, -1 for a wrong size, None when not verified.
+    # the C module has no access to the quantized image, nor strips.
+    mismatches = None
+    if verify and converter is PythonConverter and quantized is not None:
+        from .decoder import verify as verify_output
+        result = verify_output(sixel_converter, text)
+        mismatches = result.mismatches if result.size_ok else -1
+
+    # bytes of the smaller of the speed and size priority encodings
+    single = None
+    if kwargs.get("twopass"):
+        single = min([len(converter(image, **dict(kwargs, twopass=False,
+                                                  fast=fast)).getvalue())
+                      for fast in (True, False)])
+
+    pixels = width * height
+    elapsed = timings["quantize"] + timings["encode"]
+    return {
+        "kind": kind,
+        "width": width,
+        "height": height,
+        "ncolor": ncolor,
+        "backend": backend,
+        "converter": converter.__module__,
+        "mode": mode,
+        "timings": timings,
+        "bytes": len(text),
+        "bytes_per_pixel": float(len(text)) / pixels,
+        "mb_per_sec": pixels * 3 / elapsed / 1e6 if elapsed else None,
+        "peak_rss": peak_rss(),
+        "mismatches": mismatches,
+        "single_bytes": single,
+    }
+
+
+def case_key(result):
+    return (result["kind"], result["width"], result["height"],
+            result["ncolor"], result["backend"], result["mode"])
+
+
+def format_result(result):
+    timings = result["timings"]
+    mbps = result["mb_per_sec"]
+    line = ("%-6s %5dx%-5d %3d %-7s %-10s %s  %9.3f %7.3f %7.1f %9s"
+            % (result["kind"], result["width"], result["height"],
+               result["ncolor"], result["backend"], result["mode"],
+               " ".join("%8.4f" % timings[stage] for stage in STAGES),
+               result["bytes"] / 1e6, result["bytes_per_pixel"],
+               mbps or 0.0, result["peak_rss"] or "-"))
+    single = result.get("single_bytes")
+    if single:
+        line += "  %+.1f%% vs fast/size" % (100.0 * result["bytes"] / single
+                                             - 100)
+    mismatches = result.get("mismatches")
+    if mismatches == -1:
+        line += "  WRONG SIZE"
+    elif mismatches:
+        line += "  %d PIXELS DIFFER" % mismatches
+    return line
+
+
+def header():
+    return ("%-6s %11s %3s %-7s %-10s %s  %9s %7s %7s %9s"
+            % ("kind", "size", "col", "backend", "mode",
+               " ".join("%8s" % stage for stage in STAGES),
+               "out(MB)", "B/px", "MB/s", "rss(KiB)"))
+
+
+def compare(results, baseline, threshold):
+    # prints the encode time ratio of each case found in the baseline,
+    # returns the number of cases slower than 1 + threshold
+    old = dict((case_key(r), r) for r in baseline["results"])
+    regressions = 0
+    for result in results:
+        previous = old.get(case_key(result))
+        if previous is None:
+            continue
+        before = previous["timings"]["quantize"] + previous["timings"]["encode"]
+        after = result["timings"]["quantize"] + result["timings"]["encode"]
+        if not before:
+            continue
+        ratio = after / before
+        mark = ""
+        if ratio > 1 + threshold:
+            mark = "  REGRESSION"
+            regressions += 1
+        print("%-6s %5dx%-5d %3d %-7s %-10s %6.2fx%s"
+              % (result["kind"], result["width"], result["height"],
+                 result["ncolor"], result["backend"], result["mode"],
+                 ratio, mark))
+    return regressions
+
+
+def _split(value):
+    return [v for v in value.split(",") if v]
+
+
+def _parse_size(value):
+    width, height = value.lower().split("x")
+    return int(width), int(height)
+
+
+def main():
+    parser = optparse.OptionParser(usage="python -m sixel.bench [options]")
+
+    parser.add_option("--sizes",
+                      dest="sizes",
+                      default="160x120,640x480,1280x720",
+                      help="Comma separated image sizes (default: "
+                           "160x120,640x480,1280x720)")
+
+    parser.add_option("--kinds",
+                      dest="kinds",
+                      default=",".join(KINDS),
+                      help="Image kinds, from %s" % ",".join(KINDS))
+
+    parser.add_option("--colors",
+                      dest="colors",
+                      default="16,256",
+                      help="Comma separated color counts (default: 16,256)")
+
+    parser.add_option("--backends",
+                      dest="backends",
+                      default=",".join(BACKENDS),
+                      help="Backends, from %s; unavailable ones are "
+                           "skipped" % ",".join(BACKENDS))
+
+    parser.add_option("--modes",
+                      dest="modes",
+                      default=",".join(sorted(MODES)),
+                      help="Modes, from %s" % ",".join(sorted(MODES)))
+
+    parser.add_option("-r", "--repeat",
+                      dest="repeat",
+                      type="int",
+                      default=3,
+                      help="Runs per stage, the best one is kept (default: 3)")
+
+    parser.add_option("--quick",
+                      action="store_true",
+                      dest="quick",
+                      default=False,
+                      help="Only the smallest size, one run per stage")
+
+    parser.add_option("--no-isolate",
+                      action="store_false",
+                      dest="isolate",
+                      default=True,
+                      help="Run all the cases in this process; peak RSS is "
+                           "then the largest so far")
+
+    parser.add_option("--verify",
+                      action="store_true",
+                      dest="verify",
+                      default=False,
+                      help="Decode the output of every case and compare it "
+                           "with the image; exit with 1 if any differs")
+
+    parser.add_option("-o", "--json",
+                      dest="json",
+                      help="Save the results as JSON")
+
+    parser.add_option("--compare",
+                      dest="compare",
+                      help="Compare with results saved by --json")
+
+    parser.add_option("--threshold",
+                      dest="threshold",
+                      type="float",
+                      default=0.1,
+                      help="Slowdown reported as a regression (default: 0.1)")
+
+    options, args = parser.parse_args()
+
+    sizes = [_parse_size(s) for s in _split(options.sizes)]
+    repeat = options.repeat
+    if options.quick:
+        sizes = sizes[:1]
+        repeat = 1
+    kinds = _split(options.kinds)
+    colors = [int(c) for c in _split(options.colors)]
+    modes = _split(options.modes)
+    for mode in modes:
+        if mode not in MODES:
+            parser.error("unknown mode: %s" % mode)
+    backends = []
+    for backend in _split(options.backends):
+        if backend not in BACKENDS:
+            parser.error("unknown backend: %s" % backend)
+        if get_converter(backend) is None:
+            sys.stderr.write("backend %s is not available, skipped\n"
+                             % backend)
+        else:
+            backends.append(backend)
+
+    print(header())
+    results = []
+    for kind in kinds:
+        for size in sizes:
+            png = io.BytesIO()
+            generate(kind, size[0], size[1]).save(png, "PNG")
+            png = png.getvalue()
+            for ncolor in colors:
+                for backend in backends:
+                    for mode in modes:
+                        args = (png, kind, size, ncolor, backend, mode,
+                                repeat, options.verify)
+                        if options.isolate:
+                            result = run_isolated(run_case, *args)
+                        else:
+                            result = run_case(*args)
+                        print(format_result(result))
+                        sys.stdout.flush()
+                        results.append(result)
+
+    if options.json:
+        from PIL import Image
+        report = {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "pillow": getattr(Image, "__version__", None),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "results": results,
+        }
+        f = open(options.json, "w")
+        try:
+            json.dump(report, f, indent=1, sort_keys=True)
+        finally:
+            f.close()
+
+    twopass = [r for r in results if r.get("single_bytes")]
+    if twopass:
+        before = sum([r["single_bytes"] for r in twopass])
+        after = sum([r["bytes"] for r in twopass])
+        print("")
+        print("two-pass: %.3f MB, %.3f MB in the smaller single mode, "
+              "%.1f%% saved" % (after / 1e6, before / 1e6,
+                                100.0 - 100.0 * after / before))
+
+    failed = [r for r in results if r.get("mismatches")]
+    if failed:
+        sys.stderr.write("%d cases do not decode to their image\n"
+                         % len(failed))
+
+    if options.compare:
+        f = open(options.compare)
+        try:
+            baseline = json.load(f)
+        finally:
+            f.close()
+        print("")
+        if compare(results, baseline, options.threshold):
+            sys.exit(1)
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
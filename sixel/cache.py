@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# ***** BEGIN LICENSE BLOCK *****
+# Copyright (C) 2012-2014  Hayaki Saito <user@zuse.jp>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# ***** END LICENSE BLOCK *****
+
+import os
+import zlib
+import struct
+import hashlib
+import threading
+from collections import OrderedDict
+
+# files in the cache directory: this header (magic, width, height and
+# the number of palette bytes), the palette bytes, then the zlib
+# compressed palette indices
+_MAGIC = b"SIXQ"
+_HEADER = struct.Struct("!4sIIH")
+
+
+def read_content(file):
+    # returns the raw bytes of a filename or a file object, rewinding
+    # the latter so that it can still be decoded
+    if hasattr(file, "read"):
+        try:
+            file.seek(0)
+        except Exception:
+            pass
+        content = file.read()
+        try:
+            file.seek(0)
+        except Exception:
+            pass
+        return content
+    f = open(file, "rb")
+    try:
+        return f.read()
+    finally:
+        f.close()
+
+
+class QuantizeCache:
+
+    # LRU cache of quantized images, entries are (size, palette, data)
+    # tuples where data holds the palette indices of the image.
+    # the in-memory part is bounded by maxsize bytes; when a directory
+    # is given, entries are also stored there, bounded by maxdisksize.
+    # the directory is only scanned when the bytes stored since the last
+    # scan take it over maxdisksize, other processes may share it.
+
+    def __init__(self,
+                 maxsize=64 * 1024 * 1024,
+                 directory=None,
+                 maxdisksize=256 * 1024 * 1024):
+        self._maxsize = maxsize
+        self._directory = directory
+        self._maxdisksize = maxdisksize
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self._disklock = threading.Lock()
+        self._disksize = None  # bytes in the directory, None until scanned
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if directory is not None and not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def key(self, content, *options):
+        digest = hashlib.sha1(content)
+        digest.update(repr(options).encode("ascii"))
+        return digest.hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._entries[key] = entry
+                self.hits += 1
+                return entry
+        entry = self.__load(key)
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.__insert(key, entry)
+        return entry
+
+    def put(self, key, entry):
+        with self._lock:
+            self.__insert(key, entry)
+        self.__store(key, entry)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def __insert(self, key, entry):
+        size = len(entry[2])
+        if size > self._maxsize:
+            return
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._size -= len(old[2])
+        self._entries[key] = entry
+        self._size += size
+        while self._size > self._maxsize:
+            _, old = self._entries.popitem(last=False)
+            self._size -= len(old[2])
+            self.evictions += 1
+
+    def __path(self, key):
+        return os.path.join(self._directory, key + ".cache")
+
+    def __load(self, key):
+        if self._directory is None:
+            return None
+        path = self.__path(key)
+        try:
+            f = open(path, "rb")
+        except IOError:
+            return None
+        try:
+            content = f.read()
+        finally:
+            f.close()
+        try:
+            magic, width, height, length = _HEADER.unpack_from(content)
+            start = _HEADER.size + length
+            palette = list(bytearray(content[_HEADER.size:start]))
+            data = zlib.decompress(content[start:])
+        except (struct.error, zlib.error):
+            return None
+        if magic != _MAGIC or len(palette) != length \
+                or len(data) != width * height:
+            return None
+        os.utime(path, None)
+        return (width, height), palette, data
+
+    def __store(self, key, entry):
+        if self._directory is None:
+            return
+        (width, height), palette, data = entry
+        palette = bytes(bytearray(palette))
+        content = (_HEADER.pack(_MAGIC, width, height, len(palette))
+                   + palette + zlib.compress(data, 1))
+        path = self.__path(key)
+        tmppath = "%s.%d.tmp" % (path, os.getpid())
+        f = open(tmppath, "wb")
+        try:
+            f.write(content)
+        finally:
+            f.close()
+        try:
+            replaced = os.stat(path).st_size
+        except OSError:
+            replaced = 0
+        os.rename(tmppath, path)
+        with self._disklock:
+            if self._disksize is not None:
+                self._disksize += len(content) - replaced
+            if self._disksize is None or self._disksize > self._maxdisksize:
+                self.__evict_disk()
+
+    def __evict_disk(self):
+        # removes the least recently used files over maxdisksize and
+        # sets the total of the others
+        files = []
+        total = 0
+        for name in os.listdir(self._directory):
+            if not name.endswith(".cache"):
+                continue
+            path = os.path.join(self._directory, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            files.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+        files.sort()
+        evictions = 0
+        for mtime, size, path in files:
+            if total <= self._maxdisksize:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            evictions += 1
+        self._disksize = total
+        with self._lock:
+            self.evictions += evictions
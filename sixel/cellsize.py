@@ -19,55 +19,20 @@
 # ***** END LICENSE BLOCK *****
 
 import sys
-import os
-import termios
-import select
 
+from .probe import TerminalInfo, query, get_winsize
 
-class CellSizeDetector:
-
-    def __set_raw(self):
-        fd = sys.stdin.fileno()
-        backup = termios.tcgetattr(fd)
-        try:
-            new = termios.tcgetattr(fd)
-            new[0] = 0  # c_iflag = 0
-            new[3] = 0  # c_lflag = 0
-            new[3] = new[3] & ~(termios.ECHO | termios.ICANON)
-            termios.tcsetattr(fd, termios.TCSANOW, new)
-        except Exception:
-            termios.tcsetattr(fd, termios.TCSANOW, backup)
-        return backup
-
-    def __reset_raw(self, old):
-        fd = sys.stdin.fileno()
-        termios.tcsetattr(fd, termios.TCSAFLUSH, old)
-
-    def __get_report(self, query):
-        result = ''
-        fd = sys.stdin.fileno()
-        rfds = [fd]
-        wfds = []
-        xfds = []
 
-        sys.stdout.write(query)
-        sys.stdout.flush()
+class CellSizeDetector:
 
-        rfd, wfd, xfd = select.select(rfds, wfds, xfds, 0.5)
-        if rfd:
-            result = os.read(fd, 1024)
-            return result[:-1].split(';')[1:]
-        return None
+    # asks the terminal on stdin and stdout each time, see sixel.probe
+    # for the cached probe
 
     def get_size(self):
-
-        backup_termios = self.__set_raw()
-        try:
-            height, width = self.__get_report("\x1b[14t")
-            row, column = self.__get_report("\x1b[18t")
-
-            char_width = int(width) / int(column)
-            char_height = int(height) / int(row)
-        finally:
-            self.__reset_raw(backup_termios)
-        return char_width, char_height
+        sys.stdout.flush()
+        fd = sys.stdin.fileno()
+        info = TerminalInfo(query(fd, out=sys.stdout.fileno()),
+                            get_winsize(fd))
+        if info.cellsize is None:
+            raise IOError("the terminal did not report its cell size")
+        return info.cellsize
@@ -18,11 +18,178 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 # ***** END LICENSE BLOCK *****
 
+import os
+import re
+import copy
 import sys
+import time
 if sys.version_info[0] == 3:
     xrange = range
 del sys
 
+BLOCKSIZE = 65536
+
+# runs of equal bytes
+_RUNS = re.compile(b'(.)\\1*', re.S)
+
+# the same source is compiled into the sixel_cimpl extension
+if __name__ == "sixel_cimpl":
+    IMPLEMENTATION = "C"
+else:
+    IMPLEMENTATION = "python"
+
+
+class OutputBuffer:
+
+    # collects the many small strings written by the encoders and hands
+    # them to sink() joined in blocks of about blocksize characters.
+    # without a sink the blocks are kept until drain() is called.
+
+    def __init__(self, sink=None, blocksize=BLOCKSIZE):
+        self._blocks = []
+        if sink is None:
+            sink = self._blocks.append
+        self._sink = sink
+        self._blocksize = blocksize
+        self._parts = []
+        self._size = 0
+
+    def write(self, s):
+        self._parts.append(s)
+        self._size += len(s)
+        if self._size >= self._blocksize:
+            self.flush()
+
+    def flush(self):
+        if self._parts:
+            block = ''.join(self._parts)
+            self._parts = []
+            self._size = 0
+            self._sink(block)
+
+    def drain(self):
+        self.flush()
+        value = ''.join(self._blocks)
+        del self._blocks[:]
+        return value
+
+
+_worker_converter = None
+
+
+def _init_worker(converter):
+    global _worker_converter
+    _worker_converter = converter
+
+
+def _encode_bands(start, end):
+    return _worker_converter._encode_bands(start, end)
+
+
+class PixelBuffer:
+
+    # raw pixels already in memory. data is any object supporting the
+    # buffer protocol (bytes, bytearray, mmap, ...), rows are packed
+    # without padding.
+
+    def __init__(self, data, width, height, mode="RGB"):
+        self.data = data
+        self.width = width
+        self.height = height
+        self.mode = mode
+
+
+class ConversionStats:
+
+    # filled in by SixelConverter and SixelWriter.draw when passed as
+    # stats=. timings holds the seconds spent in each stage:
+    # open (decoding), quantize, resize, encode and write.
+
+    STAGES = ("open", "quantize", "resize", "encode", "write")
+
+    def __init__(self):
+        self.implementation = None  # "C" or "python"
+        self.backend = None
+        self.timings = dict((stage, 0.0) for stage in self.STAGES)
+        self.width = 0
+        self.height = 0
+        self.colors = 0      # palette entries used by the image
+        self.runs = 0        # color runs emitted by the body encoder
+        self.bytes = 0       # characters of sixel output
+        self.cached = False  # the quantized image came from the cache
+        self.bands = {}      # bands written by each two-pass strategy
+
+    def add(self, stage, seconds):
+        self.timings[stage] += seconds
+
+    def pixels(self):
+        return self.width * self.height
+
+    def total(self):
+        return sum(self.timings.values())
+
+    def __str__(self):
+        return ("%s/%s %dx%d, colors: %d, runs: %d, bytes: %d%s%s, "
+                "%s, total: %.4fs"
+                % (self.implementation, self.backend, self.width,
+                   self.height, self.colors, self.runs, self.bytes,
+                   self.cached and " (cached)" or "",
+                   "".join(", %s bands: %d" % (strategy, self.bands[strategy])
+                           for strategy in sorted(self.bands)),
+                   ", ".join("%s: %.4fs" % (stage, self.timings[stage])
+                             for stage in self.STAGES),
+                   self.total()))
+
+
+RESAMPLE_FILTERS = ("nearest", "box", "bilinear", "hamming", "bicubic",
+                    "lanczos")
+
+
+def _target_size(size, w, h, fit):
+    # the size to resize to, or None. with fit the image is scaled to
+    # fit within w x h keeping its aspect ratio, either may be None.
+    width, height = size
+    if not w and not h:
+        return None
+    if fit:
+        scale = min([float(n) / m for n, m in ((w, width), (h, height)) if n])
+        return (max(1, int(round(width * scale))),
+                max(1, int(round(height * scale))))
+    return (w or width, h or height)
+
+
+def _resample(image, size, resample, Image):
+    filters = getattr(Image, "Resampling", Image)
+    method = getattr(filters, resample.upper())
+    try:
+        # shrinks by whole factors with reduce() before resampling
+        return image.resize(size, method, reducing_gap=3.0)
+    except TypeError:
+        return image.resize(size, method)
+
+
+def _open_pixels(file, Image):
+    # returns file as a PIL image without decoding anything, or None
+    # when it is a filename or a file object
+    if hasattr(file, "getpalette"):
+        return file
+    if hasattr(file, "__array_interface__"):
+        # HxW (grayscale), HxWx3 or HxWx4 uint8 arrays
+        shape = file.__array_interface__["shape"]
+        if file.__array_interface__["typestr"] != "|u1" \
+                or len(shape) not in (2, 3) \
+                or len(shape) == 3 and shape[2] not in (3, 4):
+            raise ValueError("unsupported array: %s, shape %s"
+                             % (file.__array_interface__["typestr"], shape))
+        return Image.fromarray(file)
+    if hasattr(file, "width") and hasattr(file, "height") \
+            and hasattr(file, "mode"):
+        size = (file.width, file.height)
+        data = getattr(file, "data", file)
+        # "L", "RGBA" and "RGBX" buffers are shared, not copied
+        return Image.frombuffer(file.mode, size, data, "raw", file.mode, 0, 1)
+    return None
+
 
 class SixelConverter:
 
@@ -33,18 +200,87 @@ class SixelConverter:
                  ncolor=256,
                  alphathreshold=0,
                  chromakey=False,
-                 fast=True):
+                 fast=True,
+                 backend="python",
+                 workers=1,
+                 cache=None,
+                 palette=None,
+                 define_palette=True,
+                 stats=None,
+                 optimize=False,
+                 dither=None,
+                 quantizer=None,
+                 quantize_sample=None,
+                 resample="bicubic",
+                 fit=False,
+                 memory_limit=None,
+                 monochrome=None,
+                 twopass=False,
+                 max_encode_time=None):
 
         self.__alphathreshold = alphathreshold
         self.__chromakey = chromakey
         self._slots = [0] * 257
+
+        # optimize is a variant of the size priority mode. the two-pass
+        # mode chooses between the two modes band by band, giving up on
+        # the planes after max_encode_time seconds. see sixel/twopass.py
+        if optimize or twopass:
+            fast = False
         self._fast = fast
+        self._optimize = optimize and not twopass
+        self._twopass = twopass
+        self._max_encode_time = max_encode_time
+        self._deadline = None
+
+        if backend not in ("python", "numpy"):
+            raise ValueError("unknown backend: %s" % backend)
+        self._backend = backend
+        self._workers = workers
 
         if ncolor >= 256:
             ncolor = 256
 
+        # a fixed palette replaces the adaptive one. its colors are all
+        # defined up front, or not at all when define_palette is false
+        # because the terminal already has them.
+        if palette is not None:
+            if not hasattr(palette, "map"):
+                from sixel.palette import FixedPalette
+                palette = FixedPalette(palette)
+            ncolor = len(palette)
+        self._fixed_palette = palette
+        self._define_palette = define_palette
+
+        # two colors or less are thresholded on luminance and encoded a
+        # band at a time, unless a palette or a quantizer is asked for.
+        # see sixel/monochrome.py
+        if monochrome is None:
+            monochrome = ncolor <= 2 and palette is None \
+                and quantizer is None
+        elif monochrome and palette is not None:
+            raise ValueError("a monochrome image can not use a fixed palette")
+        if monochrome:
+            ncolor = min(ncolor, 2)
+        self._monochrome = monochrome
+
         self._ncolor = ncolor
 
+        if not resample in RESAMPLE_FILTERS:
+            raise ValueError("unknown resample filter: %s" % resample)
+
+        if dither == "none":
+            dither = None
+        if dither is not None:
+            from sixel.dither import METHODS
+            if not dither in METHODS:
+                raise ValueError("unknown dither method: %s" % dither)
+
+        self._stats = stats
+        if stats is not None:
+            stats.implementation = IMPLEMENTATION
+            stats.backend = backend
+
         if f8bit:  # 8bit mode
             self.DCS = '\x90'
             self.ST = '\x9c'
@@ -57,26 +293,252 @@ class SixelConverter:
         except ImportError:
             import imageloader as Image
 
-        image = Image.open(file)
-        image = image.convert("RGB").convert("P",
-                                             palette=Image.ADAPTIVE,
-                                             colors=ncolor)
-        if w or h:
-            width, height = image.size
-            if not w:
-                w = width
-            if not h:
-                h = height
-            image = image.resize((w, h))
-
-        self.palette = image.getpalette()
+        if memory_limit:
+            self.__open_strips(file, w, h, fit, ncolor, palette, quantizer,
+                               quantize_sample, resample, dither,
+                               memory_limit, Image)
+            return
+
+        # file is a filename, a file object or pixels already in memory
+        # (a PIL image, a NumPy array or a PixelBuffer). in-memory pixels
+        # are used as they are and files are decoded once, the alpha
+        # channel is taken from the same decode.
+        start = time.time()
+        source = _open_pixels(file, Image)
+
+        entry = None
+        if cache is not None:
+            if source is None:
+                import io
+                from sixel.cache import read_content
+                content = read_content(file)
+                file = io.BytesIO(content)
+                key = cache.key(content, w, h, ncolor,
+                                palette and palette.key, dither,
+                                monochrome and "monochrome" or quantizer,
+                                quantize_sample, resample, fit)
+            else:
+                key = cache.key(source.tobytes(),
+                                source.mode, source.size, source.getpalette(),
+                                w, h, ncolor, palette and palette.key,
+                                dither,
+                                monochrome and "monochrome" or quantizer,
+                                quantize_sample, resample, fit)
+            entry = cache.get(key)
+
+        if entry is None:
+            # the image is brought to its final size in RGB before it is
+            # quantized. JPEG files are decoded at a reduced scale when
+            # that is still larger than the target.
+            if source is None:
+                source = Image.open(file)
+                size = _target_size(source.size, w, h, fit)
+                if size is not None and hasattr(source, "draft"):
+                    source.draft("RGB", size)
+                if stats is not None:
+                    source.load()  # Image.open() decodes lazily
+            else:
+                size = _target_size(source.size, w, h, fit)
+            if stats is not None:
+                stats.add("open", time.time() - start)
+                start = time.time()
+            image = source
+            if size is not None and size != image.size:
+                if image.mode not in ("RGB", "L"):
+                    image = image.convert("RGB")
+                image = _resample(image, size, resample, Image)
+            if stats is not None:
+                stats.add("resize", time.time() - start)
+                start = time.time()
+            if palette is not None:
+                image = palette.map(image, dither)
+            elif monochrome:
+                from sixel.monochrome import quantize as threshold
+                image = threshold(image, ncolor, dither)
+            # palettized images handed over directly keep their palette
+            elif image is not file or image.mode != "P" \
+                    or image.getcolors(ncolor) is None:
+                rgb = image.convert("RGB")
+                if quantizer is not None or quantize_sample:
+                    from sixel.quantizer import quantize
+                    image = quantize(rgb, ncolor, quantizer or "adaptive",
+                                     quantize_sample, dither)
+                else:
+                    image = rgb.convert("P",
+                                        palette=Image.ADAPTIVE,
+                                        colors=ncolor)
+                    if dither is not None:
+                        from sixel.dither import dither as dither_image
+                        image = dither_image(rgb, image, dither, ncolor)
+            if stats is not None:
+                stats.add("quantize", time.time() - start)
+            colors = image.getpalette()
+            if cache is not None:
+                cache.put(key, (image.size, colors, image.tobytes()))
+        else:
+            size, colors, data = entry
+            image = Image.frombytes("P", size, data)
+            image.putpalette(colors)
+            if stats is not None:
+                stats.cached = True
+
+        if palette is not None:
+            colors = palette.getpalette()
+        self.palette = colors
         self.data = image.getdata()
+        self._image = image
         self.width, self.height = image.size
 
+        # the color of the top left pixel, also for regions of the image
+        if chromakey:
+            self._keycolor = self.data[0]
+        else:
+            self._keycolor = -1
+
         if alphathreshold > 0:
-            self.rawdata = Image.open(file).convert("RGBA").getdata()
+            # opaque pixels are 255 in the mask, transparent ones 0
+            start = time.time()
+            if source is None:
+                source = Image.open(file)
+            alpha = source.convert("RGBA").split()[3]
+            if alpha.size != image.size:
+                alpha = _resample(alpha, image.size, resample, Image)
+            table = [0] * alphathreshold + [255] * (256 - alphathreshold)
+            self._mask = alpha.point(table[:256]).tobytes()
+            if stats is not None:
+                stats.add("open", time.time() - start)
+
+        if stats is not None:
+            stats.width, stats.height = self.width, self.height
+            stats.colors = len(image.getcolors(256) or ())
+
+    def __open_strips(self, file, w, h, fit, ncolor, palette, quantizer,
+                      quantize_sample, resample, dither, memory_limit, Image):
+        # low memory mode: the image is converted in strips of whole bands
+        # of about memory_limit bytes, see sixel/strips.py. the palette
+        # is chosen first from a sample of the image, unless it is fixed,
+        # and defined up front. the cache and workers are not used.
+        from sixel import strips
+        from sixel.palette import FixedPalette
+
+        stats = self._stats
+        start = time.time()
+        source = _open_pixels(file, Image)
+        if source is None:
+            source = Image.open(file)
+            size = _target_size(source.size, w, h, fit)
+            if size is not None and hasattr(source, "draft"):
+                source.draft("RGB", size)
+        reader = strips.StripReader(source)
+        size = _target_size(reader.size, w, h, fit) or reader.size
+        self.width, self.height = size
+        self._strip_rows = strips.strip_rows(size, reader.size,
+                                            memory_limit)
+        if stats is not None:
+            stats.add("open", time.time() - start)
+            start = time.time()
+
+        if palette is None:
+            image = strips.sample(reader, quantize_sample or strips.SAMPLE,
+                                  self._strip_rows)
+            from sixel.quantizer import choose_palette
+            palette = FixedPalette(choose_palette(image, ncolor,
+                                                  quantizer or "adaptive"))
+            self._define_palette = True
+            if stats is not None:
+                stats.add("quantize", time.time() - start)
+        self._fixed_palette = palette
+        self._ncolor = len(palette)
+        self._monochrome = self._monochrome and len(palette) <= 2
+        self.palette = palette.getpalette()
+        self._reader = reader
+        self._resample = resample
+        self._dither = dither
+        self._image = None
+        self.data = None
+        self._keycolor = -1
+
+        if stats is not None:
+            stats.width, stats.height = self.width, self.height
+            stats.colors = len(palette)
+
+    def __iter_strips(self, output, counter):
+        # strips are mapped to the palette and encoded one at a time
+        from sixel import strips
+
+        alphathreshold = self.__alphathreshold
+        table = [0] * alphathreshold + [255] * (256 - alphathreshold)
+        for top, image, alpha in strips.iter_strips(self._reader,
+                                                    (self.width, self.height),
+                                                    self._strip_rows,
+                                                    self._resample,
+                                                    alphathreshold > 0):
+            image = self._fixed_palette.map(image, self._dither)
+            region = copy.copy(self)
+            region._image = image
+            region.data = image.getdata()
+            region.height = image.size[1]
+            if alpha is not None:
+                region._mask = alpha.point(table[:256]).tobytes()
+            if top == 0 and self.__chromakey:
+                self._keycolor = region._keycolor = region.data[0]
+            for band in region.__iter_bands(output, 0, region.height,
+                                            counter):
+                yield band
 
-    def __write_header(self, output):
+    def __getstate__(self):
+        # image sequences can not be pickled, they are restored from the
+        # images by __setstate__()
+        state = self.__dict__.copy()
+        state.pop("data", None)
+        state["_stats"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self._image is not None:
+            self.data = self._image.getdata()
+
+    def crop(self, box):
+        # a converter for the rectangle box = (left, upper, right, lower)
+        # of the image, with the same palette and options. nothing is
+        # decoded or quantized again.
+        if self._image is None:
+            raise ValueError("regions need the whole image in memory")
+        left, upper, right, lower = box
+        left = max(0, left)
+        upper = max(0, upper)
+        right = min(self.width, right)
+        lower = min(self.height, lower)
+        if right <= left or lower <= upper:
+            raise ValueError("empty region: %r" % (box,))
+        region = copy.copy(self)
+        region._image = self._image.crop((left, upper, right, lower))
+        region.data = region._image.getdata()
+        region.width = right - left
+        region.height = lower - upper
+        region._slots = [0] * 257
+        if hasattr(self, "_mask"):
+            width = self.width
+            region._mask = b''.join([self._mask[y * width + left:
+                                                y * width + right]
+                                     for y in xrange(upper, lower)])
+        return region
+
+    def iter_tiles(self, box, size):
+        # yields (x, y, converter) for the tiles of size = (width, height)
+        # pixels covering box, x and y relative to the top left of box
+        left, upper, right, lower = box
+        right = min(self.width, right)
+        lower = min(self.height, lower)
+        width, height = size
+        for y in xrange(upper, lower, height):
+            for x in xrange(left, right, width):
+                region = self.crop((x, y, min(x + width, right),
+                                    min(y + height, lower)))
+                yield x - left, y - upper, region
+
+    def __write_header(self, output, height=None):
         # start Device Control String (DCS)
         output.write(self.DCS)
 
@@ -88,84 +550,281 @@ class SixelConverter:
             background_option = 1
         dpi = 75  # dummy value
         template = '%d;%d;%dq"1;1;%d;%d'
-        args = (aspect_ratio, background_option, dpi, self.width, self.height)
+        if height is None:
+            height = self.height
+        args = (aspect_ratio, background_option, dpi, self.width, height)
         output.write(template % args)
 
-    def __write_palette_section(self, output):
+    def __write_palette_section(self, output, used=None):
 
         palette = self.palette
 
-        # write palette section
-        for i in xrange(0, self._ncolor * 3, 3):
+        # write palette section, optionally only the colors in used
+        for i in xrange(0, min(self._ncolor * 3, len(palette)), 3):
             no = i / 3
+            if used is not None and not no in used:
+                continue
             r = palette[i + 0] * 100 / 256
             g = palette[i + 1] * 100 / 256
             b = palette[i + 2] * 100 / 256
             output.write('#%d;2;%d;%d;%d' % (no, r, g, b))
 
-    def __write_body_without_alphathreshold(self, output, data, keycolor):
-        for n in xrange(0, self._ncolor):
-            palette = self.palette
-            r = palette[n * 3 + 0] * 100 / 256
-            g = palette[n * 3 + 1] * 100 / 256
-            b = palette[n * 3 + 2] * 100 / 256
-            output.write('#%d;2;%d;%d;%d\n' % (n, r, g, b))
-        height = self.height
+    def __band_planes(self, data, y, band):
+        # sweep the band once, column by column. each color that
+        # appears in the band gets a plane [runs, six, first, last]
+        # holding the finished runs and the run being extended.
+        # returns the runs of each color and the colors in order of
+        # appearance.
         width = self.width
-        for y in xrange(0, height, 6):
-            if height - y <= 5:
-                band = height - y
+        planes = {}
+        order = []
+        for x in xrange(0, width):
+            p = y * width + x
+            column = {}
+            for i in xrange(0, band):
+                d = data[p + width * i]
+                column[d] = column.get(d, 0) | 1 << i
+            for d, six in column.items():
+                plane = planes.get(d)
+                if plane is None:
+                    if x:
+                        runs = [(0, x)]
+                    else:
+                        runs = []
+                    planes[d] = [runs, six, x, x]
+                    order.append(d)
+                elif plane[1] == six and plane[3] == x - 1:
+                    plane[3] = x
+                else:
+                    runs = plane[0]
+                    runs.append((plane[1], plane[3] - plane[2] + 1))
+                    if plane[3] < x - 1:
+                        runs.append((0, x - 1 - plane[3]))
+                    plane[1] = six
+                    plane[2] = plane[3] = x
+
+        result = {}
+        for n in order:
+            runs, six, first, last = planes[n]
+            runs.append((six, last - first + 1))
+            result[n] = runs
+        return result, order
+
+    def __write_body_without_alphathreshold(self, output, data, keycolor,
+                                            start, end, counter):
+        for y in xrange(start, end, 6):
+            if end - y <= 5:
+                band = end - y
             else:
                 band = 6
-            buf = []
-            set_ = set()
-
-            def add_node(n, s):
-                node = []
-                cache = 0
-                count = 0
-                if s:
-                    node.append((0, s))
-                for x in xrange(s, width):
-                    count += 1
-                    p = y * width + x
-                    six = 0
-                    for i in xrange(0, band):
-                        d = data[p + width * i]
-                        if d == n:
-                            six |= 1 << i
-                        elif not d in set_:
-                            set_.add(d)
-                            add_node(d, x)
-                    if six != cache:
-                        node.append([cache, count])
-                        count = 0
-                        cache = six
-                if cache != 0:
-                    node.append([cache, count])
-                buf.append((n, node))
-
-            add_node(data[y * width], 0)
-
-            for n, node in buf:
+
+            planes, order = self.__band_planes(data, y, band)
+            for n in order:
+                if n == keycolor:
+                    continue
+                runs = planes[n]
+                counter[0] += len(runs)
                 output.write("#%d\n" % n)
-                for six, count in node:
+                for six, count in runs:
                     if count < 4:
                         output.write(chr(0x3f + six) * count)
                     else:
                         output.write('!%d%c' % (count, 0x3f + six))
                 output.write("$\n")
             output.write("-\n")
+            yield
+
+    def __encode_band_rows(self, pixels, y, band, keycolor, selected):
+        # the band written row by row, one sixel bit per row as in the
+        # speed priority mode. returns the band, the number of runs and
+        # the color selected at its end.
+        width = self.width
+        parts = []
+        runs = 0
+        for i in xrange(0, band):
+            p = (y + i) * width
+            row = pixels[p:p + width]
+            c = chr(0x3f + (1 << i))
+            if i:
+                parts.append('$')
+            blank = 0
+            for m in _RUNS.finditer(row):
+                count = m.end() - m.start()
+                color_no = bytearray(m.group(1))[0]
+                if color_no == keycolor:
+                    blank += count
+                    continue
+                if blank:
+                    if blank < 4:
+                        parts.append('?' * blank)
+                    else:
+                        parts.append('!%d?' % blank)
+                    blank = 0
+                if color_no != selected:
+                    parts.append('#%d' % color_no)
+                    selected = color_no
+                if count < 4:
+                    parts.append(c * count)
+                else:
+                    parts.append('!%d%c' % (count, c))
+                runs += 1
+        return ''.join(parts), runs, selected
+
+    def __write_body_optimized(self, output, data, keycolor, start, end,
+                               counter):
+        # the planes of the size priority mode, written without line
+        # breaks. the color with the longest plane is painted first over
+        # the whole band with one run and the other planes are drawn on
+        # top of it. the selected color carries over from one band to
+        # the next, so the band starts with it when it can.
+        # bands with many short runs, as in noisy images, can be smaller
+        # written row by row, whichever is shorter is used.
+        width = self.width
+        pixels = self._image.tobytes()
+        selected = -1
+        for y in xrange(start, end, 6):
+            if end - y <= 5:
+                band = end - y
+            else:
+                band = 6
 
-    def __write_body_without_alphathreshold_fast(self, output, data, keycolor):
-        height = self.height
+            planes, order = self.__band_planes(data, y, band)
+            bodies = {}
+            nruns = 0
+            for n in order:
+                if n == keycolor:
+                    continue
+                runs = planes[n]
+                nruns += len(runs)
+                parts = []
+                for six, count in runs:
+                    if count < 4:
+                        parts.append(chr(0x3f + six) * count)
+                    else:
+                        parts.append('!%d%c' % (count, 0x3f + six))
+                bodies[n] = ''.join(parts)
+
+            # pixels left blank must stay blank with a key color
+            if bodies and not keycolor in planes:
+                fill = max(order, key=lambda n: len(bodies[n]))
+                full = chr(0x3f + (1 << band) - 1)
+                if width < 4:
+                    bodies[fill] = full * width
+                else:
+                    bodies[fill] = '!%d%c' % (width, full)
+                order = [fill] + [n for n in order if n != fill]
+            elif selected in bodies:
+                order = [selected] + [n for n in order if n != selected]
+
+            parts = []
+            last = selected
+            for n in order:
+                if not n in bodies:
+                    continue
+                if parts:
+                    parts.append('$')
+                if n != last:
+                    parts.append('#%d' % n)
+                    last = n
+                parts.append(bodies[n])
+            text = ''.join(parts)
+
+            # rows cost about a byte per pixel or more, only try them
+            # when the planes are heavier than half that
+            if len(text) * 2 > width * band:
+                rows, runs, row_selected = \
+                    self.__encode_band_rows(pixels, y, band, keycolor,
+                                            selected)
+                if len(rows) < len(text):
+                    text, nruns, last = rows, runs, row_selected
+            counter[0] += nruns
+            selected = last
+            output.write(text)
+            output.write('-')
+            yield
+
+    def __write_body_twopass(self, output, data, keycolor, start, end,
+                             counter):
+        # the first pass gathers the colors and runs of every band, the
+        # second one writes each band as planes or row by row, whichever
+        # is shorter, see sixel/twopass.py. colors are defined where they
+        # are first used, as in the speed priority mode. past the
+        # deadline the bands are written row by row only.
+        from sixel import twopass
+        width = self.width
+        pixels = self._image.tobytes()
+        palette = self.palette
+        slots = self._slots
+        stats = self._stats
+        deadline = self._deadline
+        bands = twopass.band_stats(pixels, width, start, end)
+        selected = -1
+        for index, y in enumerate(xrange(start, end, 6)):
+            if end - y <= 5:
+                band = end - y
+            else:
+                band = 6
+            colors, nruns = bands[index]
+            opaque = not keycolor in colors
+            colors = colors - set([keycolor])
+            if index + 1 < len(bands):
+                following = bands[index + 1][0]
+            else:
+                following = ()
+
+            # the definition of a color also selects it
+            for n in sorted(colors):
+                if slots[n] == 0:
+                    r = palette[n * 3 + 0] * 100 / 256
+                    g = palette[n * 3 + 1] * 100 / 256
+                    b = palette[n * 3 + 2] * 100 / 256
+                    slots[n] = 1
+                    output.write('#%d;2;%d;%d;%d' % (n, r, g, b))
+                    selected = n
+
+            candidates = []
+            if deadline is None or time.time() < deadline:
+                if len(colors) <= twopass.PACK_COLORS:
+                    bodies, runs = twopass.pack_planes(pixels, width, y, band,
+                                                       colors)
+                else:
+                    planes, order = self.__band_planes(data, y, band)
+                    bodies = dict((n, twopass.join_runs(planes[n]))
+                                  for n in colors)
+                    runs = sum([len(planes[n]) for n in colors])
+                candidates = [(len(text), text, runs, last, strategy)
+                              for text, last, strategy
+                              in twopass.arrange(bodies, selected, following,
+                                                 width, band, opaque)]
+            # every run costs a character or more in the rows and needs a
+            # color select but the first of each row, neighbours differ.
+            # runs of the key color are at most one more per row than the
+            # others, and are free.
+            if opaque:
+                least = nruns * 3 - band - 1
+            else:
+                least = (nruns - band) // 2
+            if not candidates or least < min(candidates)[0]:
+                text, runs, last = self.__encode_band_rows(pixels, y, band,
+                                                           keycolor, selected)
+                candidates.append((len(text), text, runs, last, "rows"))
+            size, text, runs, selected, strategy = min(candidates)
+            counter[0] += runs
+            if stats is not None:
+                stats.bands[strategy] = stats.bands.get(strategy, 0) + 1
+            output.write(text)
+            output.write('-')
+            yield
+
+    def __write_body_without_alphathreshold_fast(self, output, data, keycolor,
+                                                 start, end, counter):
         width = self.width
         n = 1
-        for y in xrange(0, height):
+        runs = 0
+        for y in xrange(start, end):
             p = y * width
             cached_no = data[p]
-            count = 1
-            c = -1
+            count = 0
             for x in xrange(0, width):
                 color_no = data[p + x]
                 if color_no == cached_no:  # and count < 255:
@@ -187,12 +846,15 @@ class SixelConverter:
                         output.write(chr(c) * count)
                     else:
                         output.write('!%d%c' % (count, c))
+                    runs += 1
                     count = 1
                     cached_no = color_no
-            if c != -1 and count > 1:
+            # the last run of the row
+            if count:
                 if cached_no == keycolor:
                     c = 0x3f
                 else:
+                    c = 0x3f + n
                     if self._slots[cached_no] == 0:
                         palette = self.palette
                         r = palette[cached_no * 3 + 0] * 100 / 256
@@ -205,103 +867,309 @@ class SixelConverter:
                     output.write(chr(c) * count)
                 else:
                     output.write('!%d%c' % (count, c))
+                runs += 1
+            counter[0] += runs
+            runs = 0
             if n == 32:
                 n = 1
                 output.write('-')  # write sixel line separator
+                yield
             else:
                 n <<= 1
                 output.write('$')  # write line terminator
 
-    def __write_body_with_alphathreshold(self, output, data, keycolor):
-        rawdata = self.rawdata
-        height = self.height
+    def __write_body_without_alphathreshold_numpy(self, output, keycolor,
+                                                  start, end, counter):
+        from sixel import npencoder
+        for band in npencoder.iter_bands_fast(npencoder.to_array(self._image),
+                                              self.palette,
+                                              keycolor,
+                                              self._slots,
+                                              start,
+                                              end,
+                                              counter):
+            output.write(band)
+            yield
+
+    def __write_body_monochrome(self, output, keycolor, start, end, counter):
+        from sixel import monochrome
+        mask = None
+        if self.__alphathreshold > 0:
+            mask = self._mask
+        for band in monochrome.iter_bands(self._image.tobytes(),
+                                          self.width,
+                                          keycolor,
+                                          mask,
+                                          start,
+                                          end,
+                                          counter):
+            output.write(band)
+            yield
+
+    def __write_body_with_alphathreshold(self, output, data, keycolor,
+                                         start, end, counter):
+        # transparent pixels (below the alpha threshold, or the key color)
+        # are skipped with blank sixels and need no color select, and a
+        # color stays selected across rows. the runs of a row are found
+        # by regular expressions over the palette indices and the alpha
+        # mask, so that Python code only runs once per run.
         width = self.width
-        max_runlength = 255
+        pixels = self._image.tobytes()
+        mask = self._mask
         n = 1
-        for y in xrange(0, height):
+        selected = -1
+        runs = 0
+        for y in xrange(start, end):
             p = y * width
-            cached_no = data[p]
-            cached_alpha = rawdata[p][3]
-            count = 1
-            c = -1
-            for x in xrange(0, width):
-                color_no = data[p + x]
-                alpha = rawdata[p + x][3]
-                if color_no == cached_no:
-                    if alpha == cached_alpha:
-                        if count < max_runlength:
-                            count += 1
-                            continue
-                if cached_no == keycolor:
-                    c = 0x3f
-                elif cached_alpha < self.__alphathreshold:
-                    c = 0x3f
-                else:
-                    c = n + 0x3f
-                if count == 1:
-                    output.write('#%d%c' % (cached_no, c))
-                elif count == 2:
-                    output.write('#%d%c%c' % (cached_no, c, c))
-                    count = 1
-                else:
-                    output.write('#%d!%d%c' % (cached_no, count, c))
-                    count = 1
-                cached_no = color_no
-                cached_alpha = alpha
-            if c != -1:
-                if cached_no == keycolor:
-                    c = 0x3f
-                if count == 1:
-                    output.write('#%d%c' % (cached_no, c))
-                elif count == 2:
-                    output.write('#%d%c%c' % (cached_no, c, c))
+            row = pixels[p:p + width]
+            alpha = mask[p:p + width]
+            edges = set([m.start() for m in _RUNS.finditer(row)])
+            edges.update([m.start() for m in _RUNS.finditer(alpha)])
+            edges = sorted(edges)
+            edges.append(width)
+            row = bytearray(row)
+            alpha = bytearray(alpha)
+            c = chr(0x3f + n)
+            blank = 0
+            for i in xrange(0, len(edges) - 1):
+                x = edges[i]
+                count = edges[i + 1] - x
+                color_no = row[x]
+                if alpha[x] == 0 or color_no == keycolor:
+                    blank += count
+                    continue
+                if blank:
+                    if blank < 4:
+                        output.write('?' * blank)
+                    else:
+                        output.write('!%d?' % blank)
+                    blank = 0
+                    runs += 1
+                if color_no != selected:
+                    output.write('#%d' % color_no)
+                    selected = color_no
+                if count < 4:
+                    output.write(c * count)
                 else:
-                    output.write('#%d!%d%c' % (cached_no, count, c))
-            output.write('$')  # write line terminator
+                    output.write('!%d%c' % (count, c))
+                runs += 1
+            # a trailing blank needs nothing, the next row starts over
+            counter[0] += runs
+            runs = 0
             if n == 32:
                 n = 1
                 output.write('-')  # write sixel line separator
+                yield
             else:
                 n <<= 1
+                output.write('$')  # write line terminator
 
-    def __write_body_section(self, output):
+    def __iter_body_section(self, output, start, end, counter):
+        # the body writers are generators which yield each time a band
+        # has been written to output. start is a multiple of 6.
+        # counter[0] is increased by the number of runs written.
         data = self.data
-        if self.__chromakey:
-            keycolor = data[0]
-        else:
-            keycolor = -1
-        if self.__alphathreshold == 0:
-            if self._fast:
-                self.__write_body_without_alphathreshold_fast(output, data, keycolor)
+        keycolor = self._keycolor
+        if self._monochrome:
+            body = self.__write_body_monochrome(output, keycolor, start, end, counter)
+        elif self.__alphathreshold == 0:
+            if self._twopass:
+                body = self.__write_body_twopass(output, data, keycolor, start, end, counter)
+            elif self._fast and self._backend == "numpy":
+                body = self.__write_body_without_alphathreshold_numpy(output, keycolor, start, end, counter)
+            elif self._fast:
+                body = self.__write_body_without_alphathreshold_fast(output, data, keycolor, start, end, counter)
+            elif self._optimize:
+                body = self.__write_body_optimized(output, data, keycolor, start, end, counter)
             else:
-                self.__write_body_without_alphathreshold(output, data, keycolor)
+                body = self.__write_body_without_alphathreshold(output, data, keycolor, start, end, counter)
         else:
-            self.__write_body_with_alphathreshold(output, data, keycolor)
+            body = self.__write_body_with_alphathreshold(output, data, keycolor, start, end, counter)
+        return body
 
     def __write_terminator(self, output):
         # write ST
         output.write(self.ST)  # terminate Device Control String
 
-    def getvalue(self):
+    def __iter_bands(self, output, start, end, counter):
+        # yields the bands between rows start and end, the first one
+        # prefixed with whatever output already holds
+        for _ in self.__iter_body_section(output, start, end, counter):
+            yield output.drain()
+        band = output.drain()
+        if band:
+            yield band
 
-        try:
-            from cStringIO import StringIO
-        except ImportError:
-            from StringIO import StringIO
-        output = StringIO()
+    def _encode_bands(self, start, end):
+        # returns the bands and the number of runs in them
+        counter = [0]
+        bands = list(self.__iter_bands(OutputBuffer(), start, end, counter))
+        return bands, counter[0]
 
-        try:
-            self.write(output)
-            value = output.getvalue()
+    def __iter_bands_parallel(self, output, counter):
+        # bands only share the palette, so it is written up front and
+        # the band ranges are encoded independently.
+        # NumPy releases the GIL, the pure-Python encoders need processes.
+        import concurrent.futures
 
-        finally:
-            output.close()
+        if self._fixed_palette is None and (self._fast or self._twopass) \
+                and self.__alphathreshold == 0:
+            self.__write_palette_section(output)
+        self._slots = [1] * 257
 
-        return value
+        nbands = (self.height + 5) // 6
+        step = max(1, nbands // (self._workers * 4)) * 6
+        starts = list(xrange(0, self.height, step))
+        ends = [min(y + step, self.height) for y in starts]
 
-    def write(self, output, bodyonly=False):
+        if self._backend == "numpy":
+            executor = concurrent.futures.ThreadPoolExecutor(self._workers)
+            function = self._encode_bands
+        else:
+            executor = concurrent.futures.ProcessPoolExecutor(
+                self._workers,
+                initializer=_init_worker,
+                initargs=(self,))
+            function = _encode_bands
+
+        prefix = output.drain()
+        with executor:
+            for bands, runs in executor.map(function, starts, ends):
+                counter[0] += runs
+                for band in bands:
+                    yield prefix + band
+                    prefix = ''
+        if prefix:
+            yield prefix
+
+    def getvalue(self):
+        return ''.join(self.iter_bands())
+
+    def __iter_selected_bands(self, output, selection, counter):
+        # encodes the selected bands, the others are left untouched on
+        # the screen by an empty band ("-")
+        index = 0
+        for start, end in selection:
+            output.write('-' * (start - index))
+            for band in self.__iter_bands(output, start * 6,
+                                          min(end * 6, self.height),
+                                          counter):
+                yield band
+            index = end
+
+    def iter_bands(self, bodyonly=False, bands=None):
+        # yields the image band by band as soon as each band is encoded.
+        # the header is part of the first band, the terminator part of
+        # the last one.
+        # bands optionally selects the band numbers to encode, the image
+        # then ends with the last selected band.
+        if bands is not None and self._image is None:
+            raise ValueError("band selection needs the whole image in memory")
+        counter = [0]
+        generator = self.__generate_bands(bodyonly, bands, counter)
+        if self._stats is not None:
+            generator = self.__measure_bands(generator, counter)
+        return generator
+
+    def __measure_bands(self, bands, counter):
+        # time spent in the encoder, not in the consumer of the bands
+        stats = self._stats
+        start = time.time()
+        for band in bands:
+            stats.add("encode", time.time() - start)
+            stats.bytes += len(band)
+            yield band
+            start = time.time()
+        stats.add("encode", time.time() - start)
+        stats.runs += counter[0]
+
+    def __generate_bands(self, bodyonly, bands, counter):
+        output = OutputBuffer()
+        if bands is not None:
+            selection = []
+            for n in sorted(set(bands)):
+                if selection and selection[-1][1] == n:
+                    selection[-1][1] = n + 1
+                else:
+                    selection.append([n, n + 1])
+            height = min(selection[-1][1] * 6, self.height) if selection else 0
+        else:
+            height = self.height
         if not bodyonly:
-            self.__write_header(output)
-        self.__write_body_section(output)
+            self.__write_header(output, height)
+        # every encoding of the image defines the colors it uses
+        self._slots = [0] * 257
+        if self._fixed_palette is not None:
+            if self._define_palette:
+                self.__write_palette_section(output)
+            self._slots = [1] * 257
+        elif self._monochrome:
+            self.__write_palette_section(output)
+        elif self._optimize and self.__alphathreshold == 0:
+            used = [n for count, n in self._image.getcolors(256) or ()]
+            self.__write_palette_section(output, set(used))
+        elif not (self._fast or self._twopass) or self.__alphathreshold > 0:
+            self.__write_palette_section(output)
+        if self._max_encode_time is not None:
+            self._deadline = time.time() + self._max_encode_time
+        if bands is not None:
+            bands = self.__iter_selected_bands(output, selection, counter)
+        elif self._image is None:
+            bands = self.__iter_strips(output, counter)
+        elif self._workers > 1 and not self._monochrome:
+            bands = self.__iter_bands_parallel(output, counter)
+        else:
+            bands = self.__iter_bands(output, 0, self.height, counter)
+        band = None
+        for next_band in bands:
+            if band is not None:
+                yield band
+            band = next_band
         if not bodyonly:
             self.__write_terminator(output)
+        tail = output.drain()
+        if band is not None:
+            tail = band + tail
+        if tail:
+            yield tail
+
+    def iter_chunks(self, bodyonly=False, blocksize=BLOCKSIZE):
+        blocks = []
+        size = 0
+        for band in self.iter_bands(bodyonly):
+            blocks.append(band)
+            size += len(band)
+            if size >= blocksize:
+                yield ''.join(blocks).encode('latin-1')
+                blocks = []
+                size = 0
+        if blocks:
+            yield ''.join(blocks).encode('latin-1')
+
+    def write_to_fd(self, fd, bodyonly=False, blocksize=BLOCKSIZE):
+        if not isinstance(fd, int):
+            fd = fd.fileno()
+        stats = self._stats
+        for chunk in self.iter_chunks(bodyonly, blocksize):
+            start = time.time()
+            view = memoryview(chunk)
+            while view:
+                view = view[os.write(fd, view):]
+            if stats is not None:
+                stats.add("write", time.time() - start)
+
+    def write(self, output, bodyonly=False):
+        stats = self._stats
+        if stats is not None:
+            write = output.write
+
+            def timed_write(s):
+                start = time.time()
+                write(s)
+                stats.add("write", time.time() - start)
+            output = OutputBuffer(timed_write)
+        else:
+            output = OutputBuffer(output.write)
+        for band in self.iter_bands(bodyonly):
+            output.write(band)
+        output.flush()
@@ -0,0 +1,337 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# ***** BEGIN LICENSE BLOCK *****
+# Copyright (C) 2012-2014  Hayaki Saito <user@zuse.jp>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# ***** END LICENSE BLOCK *****
+
+#
+# Sixel decoder, and a verifier comparing what a SixelConverter wrote
+# with the image it was given.
+#
+# The body is split into tokens by a regular expression; each run of a
+# sixel character paints its rows with slice assignments, so the cost
+# is per run rather than per pixel. Pixels are kept as color register
+# numbers plus one, 0 meaning not painted, and turned into RGBA at the
+# end with NumPy when it is available.
+#
+
+import re
+import sys
+import colorsys
+from array import array
+if sys.version_info[0] == 3:
+    xrange = range
+del sys
+
+_DCS = re.compile('(?:\x1bP|\x90)([0-9;]*)q')
+_ST = re.compile('\x1b\\\\|\x9c')
+_TOKEN = re.compile('([?-~]+)'              # sixel characters
+                    '|!([0-9]*)([?-~])'     # repeat
+                    # color select / define, and the sixel characters
+                    # following it
+                    '|#([0-9]*)((?:;[0-9]*)*)([?-~]*)'
+                    '|(\\$)'                # graphics carriage return
+                    '|(-)'                  # graphics new line
+                    '|"([0-9;]*)')          # raster attributes
+
+# the rows painted by each sixel character
+_BITS = [tuple(b for b in xrange(6) if v >> b & 1) for v in xrange(64)]
+
+# VT340 default color registers
+_DEFAULTS = [(0, 0, 0), (20, 20, 80), (80, 13, 13), (20, 80, 20),
+             (80, 20, 80), (20, 80, 80), (80, 80, 20), (53, 53, 53),
+             (26, 26, 26), (33, 33, 60), (60, 26, 26), (33, 60, 33),
+             (60, 33, 60), (33, 60, 60), (60, 60, 33), (80, 80, 80)]
+
+
+def _percent(v):
+    return (min(100, v) * 255 + 50) // 100
+
+
+def _params(text):
+    return [int(p) if p else 0 for p in text.split(";")] if text else []
+
+
+def _hls(h, l, s):
+    # DEC hue 0 is blue, 120 red and 240 green
+    r, g, b = colorsys.hls_to_rgb(((h + 240) % 360) / 360.0,
+                                  min(l, 100) / 100.0, min(s, 100) / 100.0)
+    return int(r * 255 + 0.5), int(g * 255 + 0.5), int(b * 255 + 0.5)
+
+
+class SixelImage:
+
+    # a decoded image. pixels is a list of rows, array('H') of color
+    # register numbers plus one, 0 for pixels left unpainted.
+    # palette maps register numbers to (r, g, b) with 8 bits per channel.
+
+    def __init__(self, width, height, pixels, palette, background=0,
+                 aspect_ratio=0):
+        self.width = width
+        self.height = height
+        self.pixels = pixels
+        self.palette = palette
+        self.background = background  # P2 of the DCS, 1 is transparent
+        self.aspect_ratio = aspect_ratio
+
+    def __table(self):
+        # RGBA for each pixel value
+        registers = max(self.palette) + 1 if self.palette else 0
+        table = [(0, 0, 0, 0)]
+        for n in xrange(max(registers, 256)):
+            table.append(tuple(self.palette.get(n, (0, 0, 0))) + (255,))
+        return table
+
+    def to_array(self):
+        # HxWx4 uint8 NumPy array
+        import numpy
+
+        table = numpy.array(self.__table(), dtype=numpy.uint8)
+        values = numpy.frombuffer(b''.join([row.tobytes()
+                                            for row in self.pixels]),
+                                  dtype=numpy.uint16)
+        return table[values].reshape(self.height, self.width, 4)
+
+    def to_rgba(self):
+        # RGBA bytes, row by row
+        try:
+            import numpy
+        except ImportError:
+            table = [bytes(bytearray(rgba)) for rgba in self.__table()]
+            return b''.join([b''.join([table[v] for v in row])
+                             for row in self.pixels])
+        return self.to_array().tobytes()
+
+    def to_image(self):
+        from PIL import Image
+
+        return Image.frombytes("RGBA", (self.width, self.height),
+                               self.to_rgba())
+
+
+def decode(data, palette=None):
+    # decodes sixel data (str or bytes) with or without the DCS envelope.
+    # palette optionally gives the registers the terminal already has,
+    # as {n: (r, g, b)}, in place of the VT340 defaults.
+    if not isinstance(data, str):
+        data = data.decode('latin-1')
+    background = aspect_ratio = 0
+    m = _DCS.search(data)
+    if m is not None:
+        params = _params(m.group(1))
+        if len(params) > 0:
+            aspect_ratio = params[0]
+        if len(params) > 1:
+            background = params[1]
+        data = data[m.end():]
+    m = _ST.search(data)
+    if m is not None:
+        data = data[:m.start()]
+
+    if palette is None:
+        registers = dict((n, tuple(_percent(v) for v in rgb))
+                         for n, rgb in enumerate(_DEFAULTS))
+    else:
+        registers = dict(palette)
+
+    width = height = 0   # raster attributes
+    allocated = 0        # columns of the rows
+    rows = []            # rows of the current and previous bands
+    fills = {}           # color register -> array of pixel values
+    color = 0
+    value = 1
+    fill = None
+    x = y = 0
+    extent = 0           # rightmost column painted, plus one
+    bits = _BITS
+
+    def grow(rows, width, height):
+        for row in rows:
+            if len(row) < width:
+                row.extend(array('H', [0]) * (width - len(row)))
+        while len(rows) < height:
+            rows.append(array('H', [0]) * width)
+
+    for m in _TOKEN.finditer(data):
+        kind = m.lastindex
+        if kind == 1:
+            chars = m.group(1)
+        elif kind == 3:
+            chars = None
+            count = int(m.group(2) or 1)
+            c = m.group(3)
+        elif kind == 6:
+            color = int(m.group(4) or 0)
+            value = color + 1
+            fill = None
+            params = m.group(5)
+            if params:
+                params = _params(params[1:])
+                if len(params) >= 4:
+                    system, c1, c2, c3 = params[:4]
+                    if system == 1:
+                        registers[color] = _hls(c1, c2, c3)
+                    elif system == 2:
+                        registers[color] = (_percent(c1), _percent(c2),
+                                            _percent(c3))
+            chars = m.group(6)
+            if not chars:
+                continue
+        elif kind == 7:
+            x = 0
+            continue
+        elif kind == 8:
+            x = 0
+            y += 6
+            continue
+        else:
+            params = _params(m.group(9))
+            if len(params) >= 4:
+                width, height = params[2:4]
+            continue
+
+        # paint the sixel characters, or count times the character c
+        end = x + (len(chars) if chars is not None else count)
+        if end > allocated or y + 6 > len(rows):
+            if end > allocated:
+                allocated = max(end, allocated * 2)
+                fills = {}
+                fill = None
+            grow(rows, allocated, y + 6)
+        if chars is None:
+            if fill is None:
+                fill = fills.get(color)
+                if fill is None:
+                    fill = fills[color] = array('H', [value]) * allocated
+            for b in bits[ord(c) - 0x3f]:
+                rows[y + b][x:end] = fill[:count]
+        else:
+            for c in chars:
+                for b in bits[ord(c) - 0x3f]:
+                    rows[y + b][x] = value
+                x += 1
+        x = end
+        if end > extent:
+            extent = end
+
+    # the image is the raster size, or larger where painted beyond it
+    painted = len(rows)
+    while painted > height and not any(rows[painted - 1]):
+        painted -= 1
+    width = max(width, extent)
+    height = max(height, painted)
+    grow(rows, width, height)
+    pixels = [row[:width] for row in rows[:height]]
+    return SixelImage(width, height, pixels, registers, background,
+                      aspect_ratio)
+
+
+class VerifyResult:
+
+    def __init__(self, width, height, mismatches, positions, size_ok=True):
+        self.width = width
+        self.height = height
+        self.mismatches = mismatches  # pixels that differ
+        self.positions = positions    # (x, y) of the first ones
+        self.size_ok = size_ok        # the decoded size is the image size
+
+    def __bool__(self):
+        return self.size_ok and not self.mismatches
+
+    __nonzero__ = __bool__
+
+    def __str__(self):
+        if not self.size_ok:
+            return "verify: size mismatch, %dx%d decoded" % (self.width,
+                                                            self.height)
+        return ("verify: %d of %d pixels differ%s"
+                % (self.mismatches, self.width * self.height,
+                   self.positions and ", first at %s"
+                   % ", ".join("(%d, %d)" % p for p in self.positions) or ""))
+
+
+def expected_rgba(converter):
+    # the RGBA image a SixelConverter encodes, with colors rounded to the
+    # percent precision of sixel color definitions and transparent
+    # pixels (alpha threshold, key color) fully transparent
+    from PIL import Image
+
+    image = converter._image
+    if image is None:
+        raise ValueError("verification needs the whole image in memory")
+    palette = converter.palette
+    channels = []
+    for channel in xrange(3):
+        table = bytearray(256)
+        for n in xrange(min(256, len(palette) // 3)):
+            table[n] = _percent(palette[n * 3 + channel] * 100 // 256)
+        channels.append(bytes(table))
+    keycolor = converter._keycolor
+    alpha = bytearray([255]) * 256
+    if 0 <= keycolor < 256:
+        alpha[keycolor] = 0
+    channels.append(bytes(alpha))
+    data = image.tobytes()
+    planes = [Image.frombytes("L", image.size, data.translate(table))
+              for table in channels]
+    mask = getattr(converter, "_mask", None)
+    if mask is not None:
+        from PIL import ImageChops
+        mask = Image.frombytes("L", image.size, mask)
+        planes[3] = ImageChops.multiply(planes[3], mask)
+    return Image.merge("RGBA", planes).tobytes()
+
+
+def verify(converter, data=None, limit=10):
+    # decodes data, converter.getvalue() by default, and compares it
+    # with the image converter was made from. returns a VerifyResult.
+    if data is None:
+        data = converter.getvalue()
+    palette = None
+    if converter._fixed_palette is not None \
+            and not converter._define_palette:
+        # the terminal is expected to have the palette already
+        colors = converter.palette
+        palette = dict((n, tuple(_percent(v * 100 // 256)
+                                 for v in colors[n * 3:n * 3 + 3]))
+                       for n in xrange(len(colors) // 3))
+    decoded = decode(data, palette)
+    width, height = converter.width, converter.height
+    if (decoded.width, decoded.height) != (width, height):
+        return VerifyResult(decoded.width, decoded.height, 0, [], False)
+
+    expected = expected_rgba(converter)
+    actual = decoded.to_rgba()
+    try:
+        import numpy
+    except ImportError:
+        differ = [i for i in xrange(width * height)
+                  if not _same(expected, actual, i * 4)]
+    else:
+        a = numpy.frombuffer(expected, dtype=numpy.uint8).reshape(-1, 4)
+        b = numpy.frombuffer(actual, dtype=numpy.uint8).reshape(-1, 4)
+        # the color of transparent pixels does not matter
+        same = (a[:, 3] == b[:, 3]) & ((a[:, 3] == 0) | (a == b).all(1))
+        differ = numpy.flatnonzero(~same)
+    positions = [(int(i) % width, int(i) // width) for i in differ[:limit]]
+    return VerifyResult(width, height, len(differ), positions)
+
+
+def _same(a, b, i):
+    if a[i + 3] != b[i + 3]:
+        return False
+    return a[i + 3] == 0 or a[i:i + 3] == b[i:i + 3]
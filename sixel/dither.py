@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# ***** BEGIN LICENSE BLOCK *****
+# Copyright (C) 2012-2014  Hayaki Saito <user@zuse.jp>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# ***** END LICENSE BLOCK *****
+
+#
+# Dithering between the palette and the body encoder.
+#
+# "bayer" adds an 8x8 ordered threshold map to the pixels before they
+# are mapped to the nearest palette color, with two whole-image PIL
+# operations. "floyd-steinberg" is PIL's error diffusion, which runs
+# row by row in C.
+#
+
+METHODS = ("none", "bayer", "floyd-steinberg")
+
+
+def bayer_matrix(size=8):
+    # threshold map with values 0 .. size * size - 1
+    matrix = [[0]]
+    n = 1
+    while n < size:
+        matrix = ([[4 * v for v in row] + [4 * v + 2 for v in row]
+                   for row in matrix] +
+                  [[4 * v + 3 for v in row] + [4 * v + 1 for v in row]
+                   for row in matrix])
+        n *= 2
+    return matrix
+
+
+def spread(colors):
+    # amplitude of the threshold map for a flat [r, g, b, ...] palette.
+    # palettes built by median cut are far from uniform, so it follows
+    # the median distance from each color to its nearest neighbour.
+    colors = [tuple(colors[i:i + 3]) for i in range(0, len(colors) - 2, 3)]
+    colors = list(set(colors))
+    if len(colors) < 2:
+        return 0
+    nearest = []
+    for i, (r, g, b) in enumerate(colors):
+        best = None
+        for j, (r2, g2, b2) in enumerate(colors):
+            if i != j:
+                d = (r - r2) ** 2 + (g - g2) ** 2 + (b - b2) ** 2
+                if best is None or d < best:
+                    best = d
+        nearest.append(best)
+    nearest.sort()
+    return min(128, int(1.5 * nearest[len(nearest) // 2] ** 0.5))
+
+
+def threshold_image(size, amount):
+    # the Bayer map tiled over size, scaled to 0 .. amount
+    from PIL import Image
+
+    width, height = size
+    matrix = bayer_matrix()
+    n = len(matrix)
+    rows = []
+    for row in matrix:
+        levels = bytearray([v * amount // (n * n) for v in row])
+        rows.append(bytes((levels * (width // n + 1))[:width]))
+    data = b''.join([rows[y % n] for y in range(height)])
+    return Image.frombytes("L", size, data)
+
+
+def ordered(image, colors):
+    # image with the threshold map added, centered on zero
+    from PIL import Image, ImageChops
+
+    amount = spread(colors)
+    offset = threshold_image(image.size, amount)
+    offset = Image.merge("RGB", (offset, offset, offset))
+    return ImageChops.add(image.convert("RGB"), offset, 1.0, -(amount // 2))
+
+
+def floyd_steinberg(image, palette_image):
+    from PIL import Image
+
+    dither = getattr(Image, "Dither", Image).FLOYDSTEINBERG
+    return image.convert("RGB").quantize(palette=palette_image,
+                                         dither=dither)
+
+
+def dither(image, palette_image, method, ncolor=256):
+    # maps image to the first ncolor colors of the "P" image
+    # palette_image
+    from PIL import Image
+
+    if method == "floyd-steinberg":
+        return floyd_steinberg(image, palette_image)
+    if method == "bayer":
+        image = ordered(image, palette_image.getpalette()[:ncolor * 3])
+    elif method != "none":
+        raise ValueError("unknown dither method: %s" % method)
+    none = getattr(Image, "Dither", Image).NONE
+    return image.convert("RGB").quantize(palette=palette_image, dither=none)
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# ***** BEGIN LICENSE BLOCK *****
+# Copyright (C) 2012-2014  Hayaki Saito <user@zuse.jp>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# ***** END LICENSE BLOCK *****
+
+#
+# Monochrome conversion, for charts, plots and QR codes.
+#
+# The image is thresholded (or dithered) on its luminance instead of
+# being quantized, color 0 being the average of its dark pixels and
+# color 1 that of its light ones.
+#
+# A band is encoded as two planes. The rows of the band are read as
+# big integers of one byte per pixel, each row translated to its sixel
+# bit, so that OR-ing them gives the sixel values of the whole band and
+# the other plane is its complement; adding "?" to every byte at once
+# gives the characters. Only the runs are then found by a regular
+# expression, no Python code runs per pixel.
+#
+# The two planes of an opaque band change at the same columns, so their
+# bodies only differ by the trailing blanks left out. The plane drawn as
+# one run over the band is chosen from its last column and is not
+# encoded at all.
+#
+
+import re
+import binascii
+import sys
+if sys.version_info[0] == 3:
+    xrange = range
+del sys
+
+THRESHOLD = 128
+
+# runs of 4 characters or more are written as repeats
+_REPEATS = re.compile('(.)\\1{3,}')
+
+# palette index (0 or 1) to the sixel bit of the row in the band, and
+# alpha mask (0 or 255) to the same bit
+_BITS = [bytes(bytearray([(v & 1) << i for v in xrange(256)]))
+         for i in xrange(6)]
+_MASK_BITS = [bytes(bytearray([(v >> 7) << i for v in xrange(256)]))
+              for i in xrange(6)]
+
+
+if hasattr(int, "from_bytes"):
+    def to_int(data):
+        return int.from_bytes(data, "big")
+
+    def to_bytes(n, width):
+        return n.to_bytes(width, "big")
+else:  # Python 2
+    def to_int(data):
+        return int(binascii.hexlify(data), 16) if data else 0
+
+    def to_bytes(n, width):
+        return binascii.unhexlify('%0*x' % (width * 2, n))
+
+
+def _mean(stat, default):
+    if not stat.count[0]:
+        return default
+    return [int(v + 0.5) for v in stat.mean[:3]]
+
+
+def quantize(image, ncolor=2, dither=None):
+    # image as a "P" image of ncolor (1 or 2) colors, thresholded on
+    # luminance. dither is None, "bayer" or "floyd-steinberg".
+    from PIL import Image, ImageChops, ImageStat
+
+    rgb = image.convert("RGB")
+    luminance = rgb.convert("L")
+    if ncolor < 2:
+        index = Image.new("L", rgb.size, 0)
+    elif dither == "floyd-steinberg":
+        index = luminance.convert("1").convert("L")
+    else:
+        if dither == "bayer":
+            from sixel.dither import threshold_image
+            offset = threshold_image(rgb.size, 256)
+            luminance = ImageChops.add(luminance, offset, 1.0, -128)
+        index = luminance
+    index = index.point([0] * THRESHOLD + [1] * (256 - THRESHOLD))
+
+    light = index.point([0, 255] + [0] * 254)
+    colors = _mean(ImageStat.Stat(rgb, ImageChops.invert(light)), [0] * 3)
+    if ncolor >= 2:
+        colors += _mean(ImageStat.Stat(rgb, light), [255] * 3)
+
+    image = Image.frombytes("P", rgb.size, index.tobytes())
+    image.putpalette(colors)
+    return image
+
+
+def _encode_plane(plane, blank, width):
+    # the sixel characters of a plane, trailing blanks left out
+    text = to_bytes(plane + blank, width).decode('ascii').rstrip('?')
+    return _REPEATS.subn(lambda m: '!%d%s' % (len(m.group(0)), m.group(1)),
+                         text)
+
+
+def iter_bands(pixels, width, keycolor=-1, mask=None, start=0, end=0,
+               counter=None):
+    # yields the bands of rows start .. end - 1 of pixels, the palette
+    # indices (0 or 1) of an image of width columns. pixels of keycolor,
+    # or 0 in the alpha mask, are left blank. counter[0] is increased
+    # by the number of runs.
+    blank = to_int(b'\x3f' * width)
+    ones = to_int(b'\x01' * width)
+    runs = 0
+    for y in xrange(start, end, 6):
+        band = min(6, end - y)
+        light = 0
+        for i in xrange(band):
+            p = (y + i) * width
+            light |= to_int(pixels[p:p + width].translate(_BITS[i]))
+        full = ones * ((1 << band) - 1)
+        planes = [light ^ full, light]
+
+        opaque = mask is None
+        if not opaque:
+            visible = 0
+            for i in xrange(band):
+                p = (y + i) * width
+                visible |= to_int(mask[p:p + width].translate(_MASK_BITS[i]))
+            opaque = visible == full
+            planes = [plane & visible for plane in planes]
+        if 0 <= keycolor < 2:
+            planes[keycolor] = 0
+            opaque = False
+
+        # the plane with the longer body, the one not blank in the last
+        # column, is drawn as one run over the whole band and the other
+        # one on top of it
+        fill = None
+        if opaque and planes[0] and planes[1]:
+            fill = 1 if planes[0] & 0xff == 0 else 0
+        bodies = []
+        for n in (0, 1):
+            if n == fill:
+                c = chr(0x3f + (1 << band) - 1)
+                bodies.insert(0, (n, '!%d%s' % (width, c)))
+                runs += 1
+            elif planes[n]:
+                text, repeats = _encode_plane(planes[n], blank, width)
+                bodies.append((n, text))
+                runs += repeats + 1
+
+        parts = []
+        for n, text in bodies:
+            if parts:
+                parts.append('$')
+            parts.append('#%d%s' % (n, text))
+        parts.append('-')
+        if counter is not None:
+            counter[0] += runs
+            runs = 0
+        yield ''.join(parts)
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# ***** BEGIN LICENSE BLOCK *****
+# Copyright (C) 2012-2014  Hayaki Saito <user@zuse.jp>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# ***** END LICENSE BLOCK *****
+
+#
+# NumPy implementation of the speed priority encoder.
+#
+# The bands are split into runs with array operations. Every run is
+# written as three tokens: the color select (with the palette definition
+# the first time the color is used), the repeat count and the sixel
+# character followed by the line terminator, if any. The tokens are
+# strings of a small pool, so the output is gathered from the pool in
+# one indexing operation and no Python code runs per pixel or per run.
+#
+
+import numpy
+
+_BATCH = 1 << 16  # pixels encoded per call, rounded to whole bands
+
+# tokens of the pool: color selects, definitions and selects, the empty
+# token, then the sixel characters (and doubled characters) of each
+# line terminator; the repeat counts of a width follow them
+_DEFINE = 256
+_EMPTY = 512
+_CHARS = 513
+_REPEATS = _CHARS + 3 * 128
+
+
+def _pool(strings):
+    lengths = numpy.array([len(s) for s in strings], dtype=numpy.intp)
+    starts = numpy.zeros(len(strings), dtype=numpy.intp)
+    numpy.cumsum(lengths[:-1], out=starts[1:])
+    data = numpy.frombuffer(''.join(strings).encode('ascii'),
+                            dtype=numpy.uint8)
+    return data, starts, lengths
+
+
+def to_array(image):
+    width, height = image.size
+    return numpy.frombuffer(image.tobytes(),
+                            dtype=numpy.uint8).reshape(height, width)
+
+
+class BandEncoder:
+
+    def __init__(self, palette, keycolor=-1, slots=None):
+        ncolor = len(palette) // 3
+        strings = ['#%d' % n for n in range(256)]
+        for n in range(256):
+            if n < ncolor:
+                r = palette[n * 3 + 0] * 100 // 256
+                g = palette[n * 3 + 1] * 100 // 256
+                b = palette[n * 3 + 2] * 100 // 256
+                strings.append('#%d;2;%d;%d;%d#%d' % (n, r, g, b, n))
+            else:
+                strings.append('#%d' % n)
+        strings.append('')
+        for term in ('', '$', '-'):
+            for c in range(64):
+                strings.append(chr(0x3f + c) + term)
+            for c in range(64):
+                strings.append(chr(0x3f + c) * 2 + term)
+        self._strings = strings
+        self._width = None
+        self._keycolor = keycolor
+        if slots is None:
+            slots = numpy.zeros(256, dtype=numpy.bool_)
+        self.slots = slots
+        self.runs = 0
+
+    def __set_width(self, width):
+        # the repeat counts "!<count>" of runs up to width pixels
+        repeats = ['!%d' % count if count >= 3 else ''
+                   for count in range(width + 1)]
+        self._pool, self._starts, self._lengths = \
+            _pool(self._strings + repeats)
+        self._width = width
+
+    def encode_fast(self, rows, y):
+        # rows: (nrows, width) array of palette indices, y: first row number
+        nrows, width = rows.shape
+        if width != self._width:
+            self.__set_width(width)
+        flat = rows.ravel()
+
+        # start positions of the runs, row by row
+        starts = numpy.empty((nrows, width), dtype=numpy.bool_)
+        starts[:, 0] = True
+        numpy.not_equal(rows[:, 1:], rows[:, :-1], out=starts[:, 1:])
+        index = numpy.flatnonzero(starts)
+        nruns = len(index)
+        colors = flat[index]
+        counts = numpy.empty(nruns, dtype=numpy.intp)
+        numpy.subtract(index[1:], index[:-1], out=counts[:-1])
+        counts[-1] = nrows * width - index[-1]
+        per_row = numpy.count_nonzero(starts, axis=1)
+        self.runs += nruns
+
+        # runs of the key color are blank and select no color
+        phase = (y + numpy.arange(nrows)) % 6
+        selects = colors.astype(numpy.intp)
+        bits = numpy.repeat(numpy.left_shift(1, phase), per_row)
+        iskey = colors == self._keycolor
+        if iskey.any():
+            selects[iskey] = _EMPTY
+            bits[iskey] = 0
+        # short runs are written as one or two sixel characters
+        chars = _CHARS + bits
+        chars += 64 * (counts == 2)
+        # line terminator after the last run of each row
+        terms = numpy.where(phase == 5, 2 * 128, 128)
+        chars[numpy.cumsum(per_row) - 1] += terms
+
+        # palette definitions for colors selected for the first time
+        fresh = numpy.bincount(colors, minlength=256)[:256] > 0
+        fresh &= ~self.slots
+        if 0 <= self._keycolor < 256:
+            fresh[self._keycolor] = False
+        if fresh.any():
+            candidates = numpy.flatnonzero(fresh[colors])
+            used, where = numpy.unique(colors[candidates], return_index=True)
+            selects[candidates[where]] += _DEFINE
+            self.slots[used] = True
+
+        tokens = numpy.empty((nruns, 3), dtype=numpy.intp)
+        tokens[:, 0] = selects
+        tokens[:, 1] = _REPEATS + counts
+        tokens[:, 2] = chars
+        tokens = tokens.ravel()
+
+        # each output byte is taken from its token in the pool
+        lengths = self._lengths[tokens]
+        offsets = numpy.cumsum(lengths)
+        total = offsets[-1]
+        offsets -= lengths
+        index = numpy.repeat(self._starts[tokens] - offsets, lengths)
+        index += numpy.arange(total)
+        return self._pool[index].tobytes()
+
+
+def iter_bands_fast(data, palette, keycolor, slots, start=0, end=None,
+                    counter=None):
+    # slots: palette slot flags shared with the pure-Python encoder,
+    # counter[0] is increased by the number of runs
+    height, width = data.shape
+    if end is None:
+        end = height
+    encoder = BandEncoder(palette, keycolor,
+                          numpy.array(slots[:256], dtype=numpy.bool_))
+    step = 6 * max(1, _BATCH // (width * 6))
+    try:
+        for y in range(start, end, step):
+            chunk = encoder.encode_fast(data[y:min(y + step, end)], y)
+            # "-" only appears as the band separator
+            bands = chunk.decode('ascii').split('-')
+            for band in bands[:-1]:
+                yield band + '-'
+            if bands[-1]:
+                yield bands[-1]
+    finally:
+        slots[:256] = encoder.slots.astype(int).tolist()
+        if counter is not None:
+            counter[0] += encoder.runs
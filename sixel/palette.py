@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# ***** BEGIN LICENSE BLOCK *****
+# Copyright (C) 2012-2014  Hayaki Saito <user@zuse.jp>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# ***** END LICENSE BLOCK *****
+
+
+def web_safe():
+    levels = [0, 51, 102, 153, 204, 255]
+    return [(r, g, b) for r in levels for g in levels for b in levels]
+
+
+def xterm_256():
+    colors = [(0, 0, 0), (205, 0, 0), (0, 205, 0), (205, 205, 0),
+              (0, 0, 238), (205, 0, 205), (0, 205, 205), (229, 229, 229),
+              (127, 127, 127), (255, 0, 0), (0, 255, 0), (255, 255, 0),
+              (92, 92, 255), (255, 0, 255), (0, 255, 255), (255, 255, 255)]
+    levels = [0, 95, 135, 175, 215, 255]
+    colors += [(r, g, b) for r in levels for g in levels for b in levels]
+    colors += [(8 + 10 * i,) * 3 for i in range(24)]
+    return colors
+
+
+PRESETS = {
+    "web-safe": web_safe,
+    "xterm-256": xterm_256,
+}
+
+
+class FixedPalette:
+
+    # a palette shared by many images. pixels are mapped to the nearest
+    # color through a lookup table over 5 bits per channel (32^3 bins),
+    # built once by PIL and applied with NumPy when it is available.
+
+    def __init__(self, colors):
+        # colors: a preset name, a flat [r, g, b, ...] list or a
+        # sequence of (r, g, b) tuples, at most 256 colors
+        if isinstance(colors, type("")):
+            if colors not in PRESETS:
+                raise ValueError("unknown palette: %s" % colors)
+            colors = PRESETS[colors]()
+        colors = list(colors)
+        if colors and not isinstance(colors[0], int):
+            colors = [int(v) for color in colors for v in color[:3]]
+        if not 3 <= len(colors) <= 768 or len(colors) % 3:
+            raise ValueError("a palette needs 1 to 256 colors")
+        self.colors = colors
+        self.key = tuple(colors)
+        self._image = None
+        self._lut = None
+
+    def __len__(self):
+        return len(self.colors) // 3
+
+    def getpalette(self):
+        return list(self.colors)
+
+    def __palette_image(self):
+        if self._image is None:
+            from PIL import Image
+
+            # padding repeats the first color, indices past the end
+            # are folded back onto it by __fold()
+            image = Image.new("P", (1, 1))
+            image.putpalette(self.colors + self.colors[:3] * (256 - len(self)))
+            self._image = image
+        return self._image
+
+    def __fold(self, image):
+        n = len(self)
+        if n == 256:
+            return image
+        return image.point([i if i < n else 0 for i in range(256)])
+
+    def __quantize(self, image):
+        from PIL import Image
+
+        none = getattr(Image, "Dither", Image).NONE
+        return self.__fold(image.quantize(palette=self.__palette_image(),
+                                          dither=none))
+
+    def lut(self):
+        # palette index for each (r >> 3, g >> 3, b >> 3) bin
+        if self._lut is None:
+            from PIL import Image
+
+            centers = bytearray()
+            for r in range(32):
+                for g in range(32):
+                    for b in range(32):
+                        centers += bytearray((r << 3 | 4, g << 3 | 4, b << 3 | 4))
+            image = Image.frombytes("RGB", (32768, 1), bytes(centers))
+            self._lut = self.__quantize(image).tobytes()
+        return self._lut
+
+    def map(self, image, dither=None):
+        # returns a "P" image with this palette, dither is None or one
+        # of the methods of sixel.dither
+        from PIL import Image
+
+        if dither == "floyd-steinberg":
+            from .dither import floyd_steinberg
+            result = self.__fold(floyd_steinberg(image,
+                                                 self.__palette_image()))
+            result.putpalette(self.colors)
+            return result
+        if dither == "bayer":
+            from .dither import ordered
+            image = ordered(image, self.colors)
+
+        image = image.convert("RGB")
+        try:
+            import numpy
+        except ImportError:
+            result = self.__quantize(image)
+        else:
+            rgb = numpy.asarray(image) >> 3
+            index = (rgb[:, :, 0].astype(numpy.intp) << 10) \
+                | (rgb[:, :, 1].astype(numpy.intp) << 5) \
+                | rgb[:, :, 2]
+            lut = numpy.frombuffer(self.lut(), dtype=numpy.uint8)
+            result = Image.frombytes("P", image.size, lut[index].tobytes())
+        result.putpalette(self.colors)
+        return result
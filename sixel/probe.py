@@ -0,0 +1,388 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# ***** BEGIN LICENSE BLOCK *****
+# Copyright (C) 2012-2014  Hayaki Saito <user@zuse.jp>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# ***** END LICENSE BLOCK *****
+
+#
+# Terminal capability probing.
+#
+# All the queries are sent at once and the replies read in a single
+# round trip: window and cell size in pixels, text area, the number of
+# color registers and maximum sixel geometry (XTSMGRAPHICS), and DA1
+# last. Every terminal answers DA1 and answers in order, so its reply
+# ends the wait; queries a terminal does not know cost nothing.
+#
+# Results are cached per $TERM and tty, in memory and in a file for
+# later processes, for ttl seconds. An entry is dropped when the window
+# size has changed since it was probed, and the in-memory one on
+# SIGWINCH.
+#
+
+import os
+import time
+import json
+
+QUERIES = (b'\x1b[14t'        # window size in pixels: CSI 4 ; h ; w t
+           b'\x1b[16t'        # cell size in pixels: CSI 6 ; h ; w t
+           b'\x1b[18t'        # text area in cells: CSI 8 ; rows ; cols t
+           b'\x1b[?1;1;0S'    # color registers: CSI ? 1 ; 0 ; n S
+           b'\x1b[?2;1;0S'    # sixel geometry: CSI ? 2 ; 0 ; w ; h S
+           b'\x1b[c')         # DA1: CSI ? 6x ; attributes c, 4 is sixel
+
+DEFAULT_CELLSIZE = (10, 20)
+
+_GROUND, _ESCAPE, _CSI, _STRING, _STRING_ESCAPE = range(5)
+
+
+class ReplyParser:
+
+    # state machine over the bytes read from the terminal, collecting
+    # the control sequences as (private, params, final) tuples, params
+    # being a list of ints (None for empty ones). strings (DCS, OSC, APC,
+    # PM) and other text in between are skipped.
+
+    def __init__(self):
+        self.reports = []
+        self.done = False  # the DA1 reply has been read
+        self._state = _GROUND
+        self._params = []
+
+    def feed(self, data):
+        for c in bytearray(data):
+            state = self._state
+            if state == _GROUND:
+                if c == 0x1b:
+                    self._state = _ESCAPE
+                elif c == 0x9b:
+                    self.__start_csi()
+                elif c in (0x90, 0x9d, 0x9e, 0x9f):
+                    self._state = _STRING
+            elif state == _ESCAPE:
+                if c == 0x5b:  # [
+                    self.__start_csi()
+                elif c in (0x50, 0x5d, 0x5e, 0x5f):  # P ] ^ _
+                    self._state = _STRING
+                elif c != 0x1b:
+                    self._state = _GROUND
+            elif state == _CSI:
+                if 0x30 <= c <= 0x3f:
+                    self._params.append(c)
+                elif 0x20 <= c <= 0x2f:
+                    pass  # intermediate bytes, none expected
+                elif 0x40 <= c <= 0x7e:
+                    self.__end_csi(c)
+                elif c == 0x1b:
+                    self._state = _ESCAPE
+                else:
+                    self._state = _GROUND
+            elif state == _STRING:
+                if c == 0x1b:
+                    self._state = _STRING_ESCAPE
+                elif c in (0x07, 0x9c):
+                    self._state = _GROUND
+            else:  # _STRING_ESCAPE
+                if c == 0x5c:  # ESC \
+                    self._state = _GROUND
+                elif c != 0x1b:
+                    self._state = _STRING
+        return self.done
+
+    def __start_csi(self):
+        self._state = _CSI
+        self._params = []
+
+    def __end_csi(self, final):
+        self._state = _GROUND
+        text = bytes(bytearray(self._params)).decode("ascii")
+        private = ""
+        if text and text[0] in "<=>?":
+            private = text[0]
+            text = text[1:]
+        params = []
+        for param in text.split(";"):
+            if param.isdigit():
+                params.append(int(param))
+            else:
+                params.append(None)
+        report = (private, params, chr(final))
+        self.reports.append(report)
+        if private == "?" and final == 0x63:  # DA1
+            self.done = True
+
+
+class TerminalInfo:
+
+    # what the terminal told about itself, None where it did not answer
+
+    FIELDS = ("window", "cellsize", "textarea", "sixel", "colors",
+              "geometry", "attributes")
+
+    def __init__(self, reports=(), winsize=None):
+        self.window = None      # (width, height) in pixels
+        self.cellsize = None    # (width, height) of a cell in pixels
+        self.textarea = None    # (columns, rows)
+        self.sixel = None       # DA1 lists sixel graphics
+        self.colors = None      # number of color registers
+        self.geometry = None    # (width, height) of the largest image
+        self.attributes = None  # DA1 attributes
+        for private, params, final in reports:
+            self.__add(private, params, final)
+        if winsize is not None:
+            self.__add_winsize(winsize)
+
+    def __add(self, private, params, final):
+        params = [p or 0 for p in params]
+        if final == "t" and not private and len(params) >= 3:
+            kind, height, width = params[:3]
+            if kind == 4:
+                self.window = (width, height)
+            elif kind == 6:
+                self.cellsize = (width, height)
+            elif kind == 8:
+                self.textarea = (width, height)
+        elif final == "S" and private == "?" and len(params) >= 3:
+            item, status = params[:2]
+            if status == 0 and item == 1:
+                self.colors = params[2]
+            elif status == 0 and item == 2 and len(params) >= 4:
+                self.geometry = (params[2], params[3])
+        elif final == "c" and private == "?":
+            self.attributes = params[1:]
+            self.sixel = 4 in self.attributes
+        if self.cellsize is None and self.window and self.textarea \
+                and all(self.textarea):
+            self.cellsize = (self.window[0] // self.textarea[0],
+                             self.window[1] // self.textarea[1])
+        if self.cellsize is not None and not all(self.cellsize):
+            self.cellsize = None
+
+    def __add_winsize(self, winsize):
+        # (rows, columns, xpixel, ypixel) from TIOCGWINSZ fills in what
+        # the terminal did not answer
+        rows, columns, xpixel, ypixel = winsize
+        if self.textarea is None and rows and columns:
+            self.textarea = (columns, rows)
+        if self.window is None and xpixel and ypixel:
+            self.window = (xpixel, ypixel)
+        if self.cellsize is None and xpixel and ypixel and rows and columns:
+            self.cellsize = (xpixel // columns, ypixel // rows)
+
+    def to_dict(self):
+        return dict((name, getattr(self, name)) for name in self.FIELDS)
+
+    @classmethod
+    def from_dict(cls, d):
+        info = cls()
+        for name in cls.FIELDS:
+            value = d.get(name)
+            if isinstance(value, list) and name != "attributes":
+                value = tuple(value)
+            setattr(info, name, value)
+        return info
+
+    def __repr__(self):
+        return "TerminalInfo(%s)" % ", ".join("%s=%r" % (name,
+                                                        getattr(self, name))
+                                               for name in self.FIELDS)
+
+
+def get_winsize(fd):
+    # (rows, columns, xpixel, ypixel) of the tty fd, None if unknown
+    try:
+        import fcntl
+        import struct
+        import termios
+        return struct.unpack("HHHH", fcntl.ioctl(fd, termios.TIOCGWINSZ,
+                                                 b"\0" * 8))
+    except Exception:
+        return None
+
+
+def set_raw(fd):
+    # no echo, no line buffering. returns the settings to restore
+    import termios
+
+    backup = termios.tcgetattr(fd)
+    new = termios.tcgetattr(fd)
+    new[0] = 0  # c_iflag = 0
+    new[3] = new[3] & ~(termios.ECHO | termios.ICANON)
+    termios.tcsetattr(fd, termios.TCSANOW, new)
+    return backup
+
+
+def restore(fd, backup):
+    import termios
+
+    # pending input, late replies included, is discarded
+    termios.tcsetattr(fd, termios.TCSAFLUSH, backup)
+
+
+def query(fd, timeout=0.5, queries=QUERIES, out=None):
+    # sends queries to the tty fd, or to out, and returns the parsed
+    # replies read from fd until the DA1 reply or until timeout seconds
+    # have passed overall
+    import select
+
+    parser = ReplyParser()
+    backup = set_raw(fd)
+    try:
+        os.write(fd if out is None else out, queries)
+        deadline = time.time() + timeout
+        while not parser.done:
+            left = deadline - time.time()
+            if left <= 0:
+                break
+            if not select.select([fd], [], [], left)[0]:
+                break
+            data = os.read(fd, 1024)
+            if not data:
+                break
+            parser.feed(data)
+    finally:
+        restore(fd, backup)
+    return parser.reports
+
+
+class TerminalProbe:
+
+    # probes the terminal on the tty fd at most once per ttl seconds,
+    # unless its window is resized
+
+    def __init__(self, path=None, ttl=600, timeout=0.5):
+        # path: the file shared with later processes, or None
+        self._path = path
+        self._ttl = ttl
+        self._timeout = timeout
+        self._entries = {}
+        self._watching = False
+        self.probes = 0  # round trips to the terminal
+
+    def watch_resize(self):
+        # drops the in-memory results on SIGWINCH. only the main thread
+        # can install signal handlers, elsewhere this does nothing.
+        import signal
+
+        if self._watching or not hasattr(signal, "SIGWINCH"):
+            return
+        previous = signal.getsignal(signal.SIGWINCH)
+
+        def handler(signum, frame):
+            self.invalidate()
+            if callable(previous):
+                previous(signum, frame)
+
+        try:
+            signal.signal(signal.SIGWINCH, handler)
+        except ValueError:
+            return
+        self._watching = True
+
+    def invalidate(self):
+        self._entries = {}
+
+    def key(self, fd):
+        try:
+            tty = os.ttyname(fd)
+        except Exception:
+            tty = "?"
+        return "%s:%s" % (os.getenv("TERM", ""), tty)
+
+    def lookup(self, fd):
+        # the cached TerminalInfo of the terminal on fd, or None
+        key = self.key(fd)
+        winsize = get_winsize(fd)
+        now = time.time()
+        entry = self._entries.get(key)
+        if entry is None or not self.__fresh(entry, winsize, now):
+            entry = self.__load(key)
+            if entry is None or not self.__fresh(entry, winsize, now):
+                return None
+            self._entries[key] = entry
+        return TerminalInfo.from_dict(entry["info"])
+
+    def update(self, fd, reports):
+        # caches and returns the TerminalInfo of the replies to QUERIES
+        key = self.key(fd)
+        winsize = get_winsize(fd)
+        info = TerminalInfo(reports, winsize)
+        entry = {"time": time.time(),
+                 "winsize": winsize and list(winsize),
+                 "info": info.to_dict()}
+        self._entries[key] = entry
+        self.__store(key, entry)
+        self.probes += 1
+        return info
+
+    def get(self, fd, out=None):
+        # TerminalInfo of the terminal on fd, see query() for out
+        info = self.lookup(fd)
+        if info is None:
+            info = self.update(fd, query(fd, self._timeout, out=out))
+        return info
+
+    def __fresh(self, entry, winsize, now):
+        if not 0 <= now - entry["time"] < self._ttl:
+            return False
+        return entry["winsize"] == (winsize and list(winsize))
+
+    def __read_file(self):
+        try:
+            f = open(self._path)
+        except IOError:
+            return {}
+        try:
+            return json.load(f)
+        except ValueError:
+            return {}
+        finally:
+            f.close()
+
+    def __load(self, key):
+        if self._path is None:
+            return None
+        return self.__read_file().get(key)
+
+    def __store(self, key, entry):
+        if self._path is None:
+            return
+        entries = self.__read_file()
+        now = time.time()
+        for k in list(entries):
+            if not 0 <= now - entries[k].get("time", 0) < self._ttl:
+                del entries[k]
+        entries[key] = entry
+        tmppath = "%s.%d.tmp" % (self._path, os.getpid())
+        try:
+            f = open(tmppath, "w")
+            try:
+                json.dump(entries, f)
+            finally:
+                f.close()
+            os.rename(tmppath, self._path)
+        except (IOError, OSError):
+            pass
+
+
+def get_cellsize(fd, probe=None, out=None):
+    # (width, height) of a cell of the terminal on fd, DEFAULT_CELLSIZE
+    # when it is unknown
+    if probe is None:
+        info = TerminalInfo(query(fd, out=out), get_winsize(fd))
+    else:
+        info = probe.get(fd, out)
+    return info.cellsize or DEFAULT_CELLSIZE
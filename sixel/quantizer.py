@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# ***** BEGIN LICENSE BLOCK *****
+# Copyright (C) 2012-2014  Hayaki Saito <user@zuse.jp>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# ***** END LICENSE BLOCK *****
+
+#
+# Palette selection.
+#
+# A quantizer is a function (image, ncolor, sample) returning a flat
+# [r, g, b, ...] palette. "median-cut" and "kmeans" work on a histogram
+# built once by PIL, of the exact colors or of 5 bits per channel (at
+# most 32768 bins), so their cost does not grow with the number of
+# pixels. The image is then mapped to the palette with the lookup table
+# of FixedPalette.
+#
+# sample limits the number of pixels looked at; larger images are
+# subsampled first.
+#
+
+
+def subsample(image, sample):
+    # image reduced to about sample pixels at most
+    from PIL import Image
+
+    width, height = image.size
+    if not sample or width * height <= sample:
+        return image
+    scale = (float(sample) / (width * height)) ** 0.5
+    size = (max(1, int(width * scale)), max(1, int(height * scale)))
+    return image.resize(size, getattr(Image, "Resampling", Image).NEAREST)
+
+
+def histogram(image, sample=None):
+    # [(count, (r, g, b)), ...] of the exact colors when there are at
+    # most 32768 of them, else over bins of 5 bits per channel, each bin
+    # given by its center
+    image = subsample(image.convert("RGB"), sample)
+    colors = image.getcolors(32768)
+    if colors is not None:
+        return colors
+    binned = image.point([v & 0xf8 for v in range(256)] * 3)
+    return [(count, (r | 4, g | 4, b | 4))
+            for count, (r, g, b) in binned.getcolors(32768)]
+
+
+def _box(bins):
+    # [score, channel, pixels, bins]: the box is split along its widest
+    # channel, the box with the highest score (pixels times width) first
+    pixels = 0
+    low = [255, 255, 255]
+    high = [0, 0, 0]
+    for count, color in bins:
+        pixels += count
+        for channel in (0, 1, 2):
+            v = color[channel]
+            if v < low[channel]:
+                low[channel] = v
+            if v > high[channel]:
+                high[channel] = v
+    width, channel = max([(high[c] - low[c], c) for c in (0, 1, 2)])
+    if len(bins) < 2:
+        width = -1
+    return [pixels * width, channel, pixels, bins]
+
+
+def _mean(box):
+    pixels = box[2]
+    r = g = b = 0
+    for count, color in box[3]:
+        r += color[0] * count
+        g += color[1] * count
+        b += color[2] * count
+    return ((r + pixels // 2) // pixels,
+            (g + pixels // 2) // pixels,
+            (b + pixels // 2) // pixels)
+
+
+def median_cut_colors(bins, ncolor):
+    # boxes are split at the weighted median
+    boxes = [_box(bins)]
+    while len(boxes) < ncolor:
+        i = max(range(len(boxes)), key=lambda n: boxes[n][0])
+        score, channel, pixels, box = boxes[i]
+        if score < 0:
+            break
+        box = sorted(box, key=lambda entry: entry[1][channel])
+        half = pixels / 2.0
+        seen = 0
+        for cut in range(1, len(box)):
+            seen += box[cut - 1][0]
+            if seen >= half:
+                break
+        boxes[i:i + 1] = [_box(box[:cut]), _box(box[cut:])]
+    return [_mean(box) for box in boxes]
+
+
+def median_cut(image, ncolor, sample=None):
+    colors = median_cut_colors(histogram(image, sample), ncolor)
+    return [v for color in colors for v in color]
+
+
+def kmeans(image, ncolor, sample=None, iterations=4):
+    # a few Lloyd iterations over the histogram bins, starting from the
+    # median cut palette. without NumPy the median cut palette is used.
+    bins = histogram(image, sample)
+    colors = median_cut_colors(bins, ncolor)
+    try:
+        import numpy
+    except ImportError:
+        return [v for color in colors for v in color]
+
+    points = numpy.array([color for count, color in bins], dtype=numpy.float64)
+    weights = numpy.array([count for count, color in bins],
+                          dtype=numpy.float64)
+    centers = numpy.array(colors, dtype=numpy.float64)
+    for i in range(iterations):
+        # |p - c|^2 without the |p|^2 term, which does not change the
+        # nearest center
+        distances = (centers ** 2).sum(1) - 2 * numpy.dot(points, centers.T)
+        labels = distances.argmin(1)
+        total = numpy.bincount(labels, weights, len(centers))
+        used = total > 0
+        for channel in range(3):
+            sums = numpy.bincount(labels, weights * points[:, channel],
+                                  len(centers))
+            centers[used, channel] = sums[used] / total[used]
+    centers = numpy.clip(numpy.rint(centers), 0, 255).astype(int)
+    return centers.ravel().tolist()
+
+
+def adaptive(image, ncolor, sample=None):
+    # PIL's own median cut, on a subsample if asked to
+    from PIL import Image
+
+    image = subsample(image.convert("RGB"), sample)
+    image = image.convert("P", palette=Image.ADAPTIVE, colors=ncolor)
+    return image.getpalette()[:ncolor * 3]
+
+
+QUANTIZERS = {
+    "adaptive": adaptive,
+    "median-cut": median_cut,
+    "kmeans": kmeans,
+}
+
+
+def register(name, quantizer):
+    # quantizer(image, ncolor, sample) returns a flat [r, g, b, ...]
+    # list of at most ncolor colors
+    QUANTIZERS[name] = quantizer
+
+
+def choose_palette(image, ncolor=256, method="adaptive", sample=None):
+    # a flat [r, g, b, ...] palette for image, its exact colors when
+    # there are few enough of them
+    if not method in QUANTIZERS:
+        raise ValueError("unknown quantizer: %s" % method)
+    image = image.convert("RGB")
+    colors = image.getcolors(ncolor)
+    if colors is not None:
+        return [v for count, color in colors for v in color]
+    return QUANTIZERS[method](image, ncolor, sample)
+
+
+def quantize(image, ncolor=256, method="adaptive", sample=None, dither=None):
+    # returns image as a "P" image with a palette chosen by method
+    from PIL import Image
+    from .palette import FixedPalette
+
+    if not method in QUANTIZERS:
+        raise ValueError("unknown quantizer: %s" % method)
+    image = image.convert("RGB")
+    # few enough colors to be kept as they are
+    if image.getcolors(ncolor) is not None:
+        return image.convert("P", palette=Image.ADAPTIVE, colors=ncolor)
+    colors = QUANTIZERS[method](image, ncolor, sample)
+    return FixedPalette(colors).map(image, dither)
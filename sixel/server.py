@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# ***** BEGIN LICENSE BLOCK *****
+# Copyright (C) 2012-2014  Hayaki Saito <user@zuse.jp>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# ***** END LICENSE BLOCK *****
+
+#
+# sixelconv server mode.
+#
+# A request is one JSON header line (argv, cell size, whether the
+# client's stdout is a terminal and the image size) followed by the
+# image bytes. The reply is a sequence of frames, each one a type byte
+# ("D" for output, "S" for the --stats report, "E" for an error message),
+# a 4-byte big-endian length and the payload. Output is latin-1 encoded
+# so that the client can write exactly the characters the one-shot
+# command would have written.
+#
+# The client side only needs this module and sixel.cache.read_content(),
+# so sixelconv --client does not load the converter.
+#
+
+import os
+import io
+import sys
+import json
+import socket
+import struct
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+_FRAME = struct.Struct("!cI")
+
+
+def _send_frame(sock, kind, payload):
+    sock.sendall(_FRAME.pack(kind, len(payload)) + payload)
+
+
+def _recv_exactly(f, size):
+    data = f.read(size)
+    if len(data) != size:
+        raise IOError("connection closed by server")
+    return data
+
+
+class _SocketOutput:
+
+    def __init__(self, sock, isatty):
+        self._sock = sock
+        self._isatty = isatty
+
+    def write(self, s):
+        if s:
+            _send_frame(self._sock, b"D", s.encode("latin-1"))
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return self._isatty
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        try:
+            header = json.loads(self.rfile.readline().decode("utf-8"))
+            data = _recv_exactly(self.rfile, header["size"])
+            cellsize = header["cellsize"]
+            if cellsize is not None:
+                cellsize = tuple(cellsize)
+            output = _SocketOutput(self.connection, header["isatty"])
+            report = self.server.convert(header["argv"],
+                                         io.BytesIO(data),
+                                         output,
+                                         cellsize)
+            if report:
+                _send_frame(self.connection, b"S", report.encode("utf-8"))
+        except (Exception, SystemExit) as e:
+            import logging
+            logging.exception(e)
+            try:
+                _send_frame(self.connection, b"E", str(e).encode("utf-8"))
+            except Exception:
+                pass
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+
+    daemon_threads = True
+
+    def __init__(self, path, convert):
+        socketserver.UnixStreamServer.__init__(self, path, _RequestHandler)
+        self.convert = convert
+
+
+def serve(path, convert):
+    # convert(argv, imagefile, output, cellsize) does the work for each
+    # request, on its own thread, and returns what the client prints on
+    # its stderr, or None
+    if os.path.exists(path):
+        os.remove(path)
+    server = _Server(path, convert)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.remove(path)
+
+
+def request(path, argv, imagefile, output, cellsize=None, errors=None):
+    # errors: where the --stats report is written, sys.stderr by default
+    from .cache import read_content
+
+    if errors is None:
+        errors = sys.stderr
+
+    data = read_content(imagefile)
+    header = {"argv": argv,
+              "cellsize": cellsize,
+              "isatty": output.isatty(),
+              "size": len(data)}
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        sock.sendall(json.dumps(header).encode("utf-8") + b"\n" + data)
+        f = sock.makefile("rb")
+        try:
+            while True:
+                frame = f.read(_FRAME.size)
+                if not frame:
+                    break
+                if len(frame) != _FRAME.size:
+                    raise IOError("connection closed by server")
+                kind, size = _FRAME.unpack(frame)
+                payload = _recv_exactly(f, size)
+                if kind == b"E":
+                    raise RuntimeError(payload.decode("utf-8"))
+                elif kind == b"S":
+                    errors.write("%s\n" % payload.decode("utf-8"))
+                else:
+                    output.write(payload.decode("latin-1"))
+        finally:
+            f.close()
+        output.flush()
+    finally:
+        sock.close()
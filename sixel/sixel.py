@@ -19,7 +19,8 @@
 # ***** END LICENSE BLOCK *****
 
 import sys
-import os
+import time
+import inspect
 import logging
 try:
     from sixel_cimpl import SixelConverter
@@ -27,10 +28,41 @@ except ImportError as e:
     logging.exception(e)
     from .converter import SixelConverter
 
+# options of draw() after y, in the order they used to be declared
+_POSITIONAL = ("w", "h", "ncolor", "alphathreshold", "chromakey", "fast")
+
+
+def _defaults():
+    from . import converter
+    init = converter.SixelConverter.__init__
+    try:
+        spec = inspect.getfullargspec(init)
+    except AttributeError:  # Python 2
+        spec = inspect.getargspec(init)
+    return dict(zip(spec.args[-len(spec.defaults):], spec.defaults))
+
+
+_DEFAULTS = _defaults()
+_MISSING = object()
+
+
+def converter_options(kwargs):
+    # kwargs without the options left at their default, so that a
+    # sixel_cimpl built from an older converter.py still accepts them
+    # as long as no newer option is used
+    options = {}
+    for key, value in kwargs.items():
+        default = _DEFAULTS.get(key, _MISSING)
+        if value is default or type(value) is type(default) \
+                and value == default:
+            continue
+        options[key] = value
+    return options
+
 
 class SixelWriter:
 
-    def __init__(self, f8bit=False, bodyonly=False):
+    def __init__(self, f8bit=False, bodyonly=False, palette=None):
         self.f8bit = f8bit
         self._bodyonly = bodyonly
         if f8bit:  # 8bit mode
@@ -38,14 +70,27 @@ class SixelWriter:
         else:
             self.CSI = '\x1b['
 
+        # with a fixed palette, the colors are defined by the first
+        # draw and later draws only send palette indices
+        if palette is not None and not hasattr(palette, "map"):
+            from .palette import FixedPalette
+            palette = FixedPalette(palette)
+        self._palette = palette
+        self._palette_defined = False
+
+    def reset_palette(self):
+        # define the palette again on the next draw, e.g. after the
+        # terminal has been reset
+        self._palette_defined = False
+
     def save_position(self, output):
         if not self._bodyonly:
-            if os.isatty(output.fileno()):
+            if output.isatty():
                 output.write('\x1b7')  # DECSC
 
     def restore_position(self, output):
         if not self._bodyonly:
-            if os.isatty(output.fileno()):
+            if output.isatty():
                 output.write('\x1b8')  # DECRC
 
     def move_x(self, n, fabsolute, output):
@@ -68,19 +113,11 @@ class SixelWriter:
             elif n < 0:
                 output.write('%dA' % n)
 
-    def draw(self,
-             filename,
-             output=sys.stdout,
-             absolute=False,
-             x=None,
-             y=None,
-             w=None,
-             h=None,
-             ncolor=256,
-             alphathreshold=0,
-             chromakey=False,
-             fast=True):
+    def __draw(self, filename, output, streaming, absolute, x, y, args,
+               kwargs):
 
+        # the converter options that draw() used to take by position
+        kwargs.update(zip(_POSITIONAL, args))
         try:
             filename.seek(0)
         except Exception:
@@ -94,15 +131,121 @@ class SixelWriter:
             if not y is None:
                 self.move_y(y, absolute, output)
 
+            if self._palette is not None:
+                kwargs["palette"] = self._palette
+                kwargs["define_palette"] = not self._palette_defined
             sixel_converter = SixelConverter(filename,
                                              self.f8bit,
-                                             w,
-                                             h,
-                                             ncolor,
-                                             alphathreshold=alphathreshold,
-                                             chromakey=chromakey,
-                                             fast=fast)
-            sixel_converter.write(output, bodyonly=self._bodyonly)
+                                             **converter_options(kwargs))
+            if streaming:
+                stats = kwargs.get("stats")
+                for band in sixel_converter.iter_bands(bodyonly=self._bodyonly):
+                    start = time.time()
+                    output.write(band)
+                    output.flush()
+                    if stats is not None:
+                        stats.add("write", time.time() - start)
+            else:
+                sixel_converter.write(output, bodyonly=self._bodyonly)
+            if self._palette is not None:
+                self._palette_defined = True
 
         finally:
             self.restore_position(output)
+        return sixel_converter
+
+    def draw(self,
+             filename,
+             output=sys.stdout,
+             absolute=False,
+             x=None,
+             y=None,
+             *args,
+             **kwargs):
+
+        # args and kwargs are the options of SixelConverter (w, h, ncolor,
+        # fast, backend, stats, ...). returns the converter
+        return self.__draw(filename, output, False, absolute, x, y, args,
+                           kwargs)
+
+    def draw_streaming(self,
+                       filename,
+                       output=sys.stdout,
+                       absolute=False,
+                       x=None,
+                       y=None,
+                       *args,
+                       **kwargs):
+
+        # same as draw(), but each band is flushed to output as soon as
+        # it is encoded
+        return self.__draw(filename, output, True, absolute, x, y, args,
+                           kwargs)
+
+    def __move_to(self, x, y, dx, dy, absolute, output):
+        # moves to (x + dx, y + dy) cells, x and y being None for the
+        # current position
+        if x is None:
+            x, xabsolute = 0, False
+        else:
+            xabsolute = absolute
+        if y is None:
+            y, yabsolute = 0, False
+        else:
+            yabsolute = absolute
+        if xabsolute or x + dx:
+            self.move_x(x + dx, xabsolute, output)
+        if yabsolute or y + dy:
+            self.move_y(y + dy, yabsolute, output)
+
+    def draw_region(self,
+                    image,
+                    box,
+                    output=sys.stdout,
+                    absolute=False,
+                    x=None,
+                    y=None,
+                    tile=None,
+                    cellsize=(10, 20),
+                    **kwargs):
+
+        # draws the rectangle box = (left, upper, right, lower) of image
+        # at the position x, y. image is anything draw() takes, with the
+        # keyword arguments of draw(), or the converter returned by an
+        # earlier call, which is reused without decoding or quantizing
+        # the image again.
+        # tile = (columns, rows) splits the region into tiles of that many
+        # cells of cellsize pixels, each one placed on its own.
+        # returns the converter.
+        if hasattr(image, "iter_bands"):
+            sixel_converter = image
+        else:
+            try:
+                image.seek(0)
+            except Exception:
+                pass
+            if self._palette is not None:
+                kwargs["palette"] = self._palette
+                kwargs["define_palette"] = not self._palette_defined
+            sixel_converter = SixelConverter(image, self.f8bit,
+                                             **converter_options(kwargs))
+
+        char_width, char_height = cellsize
+        if tile is None:
+            tiles = [(0, 0, sixel_converter.crop(box))]
+        else:
+            size = (tile[0] * char_width, tile[1] * char_height)
+            tiles = sixel_converter.iter_tiles(box, size)
+
+        for tx, ty, region in tiles:
+            self.save_position(output)
+            try:
+                self.__move_to(x, y, tx // char_width, ty // char_height,
+                               absolute, output)
+                region.write(output, bodyonly=self._bodyonly)
+            finally:
+                self.restore_position(output)
+        output.flush()
+        if self._palette is not None:
+            self._palette_defined = True
+        return sixel_converter
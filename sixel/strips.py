@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# ***** BEGIN LICENSE BLOCK *****
+# Copyright (C) 2012-2014  Hayaki Saito <user@zuse.jp>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# ***** END LICENSE BLOCK *****
+
+#
+# Low memory conversion.
+#
+# The image is read, resized, quantized and encoded in strips of whole
+# bands, so only a strip of it is held at a time besides the source.
+# Images stored without compression (PPM, BMP, TGA, uncompressed TIFF)
+# are read from the file strip by strip and never decoded as a whole;
+# other formats are decoded once. The palette is chosen beforehand from
+# a subsample of the image taken in a first pass over the strips.
+#
+
+import sys
+import math
+import struct
+if sys.version_info[0] == 3:
+    xrange = range
+del sys
+
+# pixels in the palette sample when the quantizer is given no size
+SAMPLE = 1 << 18
+
+# bytes per pixel of a strip at the peak of its conversion: the palette
+# lookup temporaries, the palette indices and the alpha mask, and per
+# pixel of the source rows it is resized from: the rows as read and
+# their RGB and RGBA copies
+STRIP_COST = 40
+SOURCE_COST = 8
+
+# radius of the resampling filters, in source pixels when enlarging
+FILTER_SUPPORT = {
+    "nearest": 0.5,
+    "box": 0.5,
+    "bilinear": 1.0,
+    "hamming": 1.0,
+    "bicubic": 2.0,
+    "lanczos": 3.0,
+}
+
+
+def strip_rows(size, source_size, limit):
+    # rows per strip of an image of size resized from source_size,
+    # within limit bytes. strips are multiples of 24 rows so that they
+    # end on band boundaries and keep the phase of the 8x8 Bayer map.
+    width, height = size
+    source_width, source_height = source_size
+    scale = float(source_height) / max(1, height)
+    cost = width * STRIP_COST + int(source_width * scale * SOURCE_COST)
+    rows = limit // max(1, cost) // 24 * 24
+    return max(24, rows)
+
+
+def _copy_palette(source, image):
+    palette = getattr(source, "palette", None)
+    if palette is not None and image.mode in ("P", "PA"):
+        image.putpalette(palette.palette, palette.rawmode or palette.mode)
+    if "transparency" in source.info:
+        image.info["transparency"] = source.info["transparency"]
+
+
+class StripReader:
+
+    # rows of an image, read from the file when the image is stored in
+    # "raw" tiles spanning its whole width, else cropped from the image
+    # decoded once
+
+    def __init__(self, image):
+        self.image = image
+        self.size = image.size
+        self._tiles = None
+        if getattr(image, "fp", None) is not None:
+            try:
+                self._tiles = self.__raw_tiles(image)
+            except (ValueError, KeyError, TypeError, AttributeError):
+                self._tiles = None
+        if self._tiles is None:
+            image.load()
+
+    def __raw_tiles(self, image):
+        # [(top, bottom, offset, rawmode, stride, orientation), ...] or
+        # None when some tile is compressed or narrower than the image
+        from PIL import Image
+
+        width = image.size[0]
+        tiles = []
+        for tile in image.tile:
+            decoder, extents, offset, args = tuple(tile)[:4]
+            if decoder != "raw":
+                return None
+            if not isinstance(args, tuple):
+                args = (args,)
+            rawmode = args[0]
+            stride = len(args) > 1 and args[1] or 0
+            orientation = len(args) > 2 and args[2] or 1
+            x0, y0, x1, y1 = extents
+            if x0 != 0 or x1 != width or orientation not in (1, -1):
+                return None
+            if not stride:
+                stride = len(Image.new(image.mode, (width, 1))
+                             .tobytes("raw", rawmode))
+            tiles.append((y0, y1, offset, rawmode, stride, orientation))
+        return tiles or None
+
+    def read(self, top, bottom):
+        # rows top .. bottom - 1, as an image of the source mode
+        from PIL import Image
+
+        image = self.image
+        width = self.size[0]
+        if self._tiles is None:
+            return image.crop((0, top, width, bottom))
+        strip = None
+        for y0, y1, offset, rawmode, stride, orientation in self._tiles:
+            first = max(top, y0)
+            last = min(bottom, y1)
+            if first >= last:
+                continue
+            # rows stored bottom up start from the last one
+            if orientation == 1:
+                index = first - y0
+            else:
+                index = y1 - last
+            image.fp.seek(offset + index * stride)
+            data = image.fp.read((last - first) * stride)
+            part = Image.frombytes(image.mode, (width, last - first), data,
+                                   "raw", rawmode, stride, orientation)
+            if first == top and last == bottom:
+                strip = part
+                break
+            if strip is None:
+                strip = Image.new(image.mode, (width, bottom - top))
+            strip.paste(part, (0, first - top))
+        _copy_palette(image, strip)
+        return strip
+
+
+def sample(reader, pixels, rows):
+    # an RGB subsample of about pixels pixels of the whole image, taken
+    # strip by strip
+    from PIL import Image
+
+    width, height = reader.size
+    scale = min(1.0, (float(pixels) / (width * height)) ** 0.5)
+    sample_width = max(1, int(width * scale))
+    nearest = getattr(Image, "Resampling", Image).NEAREST
+    parts = []
+    done = 0
+    for top in xrange(0, height, rows):
+        bottom = min(top + rows, height)
+        # rows of the sample up to the end of this strip
+        count = max(1, int(bottom * scale)) - done
+        if count <= 0:
+            continue
+        strip = reader.read(top, bottom).convert("RGB")
+        parts.append(strip.resize((sample_width, count), nearest))
+        done += count
+    image = Image.new("RGB", (sample_width, done))
+    y = 0
+    for part in parts:
+        image.paste(part, (0, y))
+        y += part.size[1]
+    return image
+
+
+def _nearest_rows(height, target_height, Image):
+    # the source row of each row of an image of height rows resized to
+    # target_height with NEAREST, as PIL picks them
+    nearest = getattr(Image, "Resampling", Image).NEAREST
+    index = Image.frombytes("I", (1, height),
+                            struct.pack("=%di" % height, *xrange(height)))
+    index = index.resize((1, target_height), nearest)
+    return struct.unpack("=%di" % target_height, index.tobytes())
+
+
+def iter_strips(reader, size, rows, resample="bicubic", alpha=False):
+    # yields (top, rgb, alpha) for the strips of rows rows of the image
+    # brought to size, alpha being an "L" image of the alpha channel or
+    # None. with "nearest", a strip is made of the source rows the image
+    # resized as a whole would pick, so it matches it exactly. with the
+    # other filters a strip is resized from the source rows it covers
+    # and enough rows around them for the filter; the result is close to
+    # the whole image resized but not identical: the fractional offset
+    # of the strip changes the rounding of some pixels by one level, and
+    # the whole image is first reduced by whole factors when shrinking.
+    from PIL import Image
+
+    width, height = reader.size
+    target_width, target_height = size
+    method = getattr(getattr(Image, "Resampling", Image), resample.upper())
+    scale = float(height) / target_height
+    margin = int(math.ceil(FILTER_SUPPORT[resample] * max(scale, 1.0))) + 1
+    picked = None
+    if resample == "nearest" and size != reader.size:
+        picked = _nearest_rows(height, target_height, Image)
+    for top in xrange(0, target_height, rows):
+        bottom = min(top + rows, target_height)
+        if size == reader.size:
+            image = reader.read(top, bottom)
+            box = None
+        elif picked is not None:
+            first = picked[top]
+            last = picked[bottom - 1] + 1
+            image = reader.read(first, last)
+            box = None
+        else:
+            upper = top * scale
+            lower = bottom * scale
+            first = max(0, int(upper) - margin)
+            last = min(height, int(math.ceil(lower)) + margin)
+            image = reader.read(first, last)
+            box = (0, upper - first, width, lower - first)
+        mask = None
+        if alpha:
+            mask = image.convert("RGBA").split()[3]
+        image = image.convert("RGB")
+        if picked is not None:
+            image = _pick_rows(image, picked[top:bottom], first,
+                               target_width, method, Image)
+            if mask is not None:
+                mask = _pick_rows(mask, picked[top:bottom], first,
+                                  target_width, method, Image)
+        elif box is not None:
+            strip_size = (target_width, bottom - top)
+            image = image.resize(strip_size, method, box)
+            if mask is not None:
+                mask = mask.resize(strip_size, method, box)
+        yield top, image, mask
+
+
+def _pick_rows(image, picked, first, width, method, Image):
+    # the rows picked (source row numbers, from first on) of image, its
+    # width resized to width
+    image = image.resize((width, image.size[1]), method)
+    strip = Image.new(image.mode, (width, len(picked)))
+    for y, row in enumerate(picked):
+        strip.paste(image.crop((0, row - first, width, row - first + 1)),
+                    (0, y))
+    return strip
@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# ***** BEGIN LICENSE BLOCK *****
+# Copyright (C) 2012-2014  Hayaki Saito <user@zuse.jp>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# ***** END LICENSE BLOCK *****
+
+#
+# Two-pass encoding.
+#
+# The first pass goes over the bands once for the colors of each band
+# and the number of runs in its rows, which costs a few regular
+# expression calls per row. The second pass encodes each band as color
+# planes, in a few color orders, and row by row as in the speed priority
+# mode where that can be shorter, and keeps the shortest one.
+#
+# Planes of bands with few colors are packed a color at a time, as the
+# monochrome planes are (see sixel/monochrome.py), each row translated
+# to the sixel bit of the color, so that no Python code runs per pixel.
+# Bands with more colors are swept column by column.
+#
+# The speed priority mode is one of the candidates of every band and the
+# size priority mode writes the same planes with line breaks, so the
+# output is never larger than either.
+#
+
+import re
+import sys
+if sys.version_info[0] == 3:
+    xrange = range
+del sys
+
+from sixel.monochrome import to_int, to_bytes
+
+# bands with more colors than this are swept column by column
+PACK_COLORS = 16
+
+# runs of equal bytes, and of equal sixel characters
+_RUNS = re.compile(b'(.)\\1*', re.S)
+_CHARS = re.compile('(.)\\1*')
+# runs of 4 characters or more are written as repeats
+_REPEATS = re.compile('(.)\\1{3,}')
+
+# (color, row) -> translate table of the color to the sixel bit of the
+# row in the band
+_tables = {}
+
+
+def _table(n, i):
+    table = _tables.get((n, i))
+    if table is None:
+        table = bytearray(256)
+        table[n] = 1 << i
+        table = _tables[(n, i)] = bytes(table)
+    return table
+
+
+def _repeat(m):
+    return '!%d%s' % (len(m.group(0)), m.group(1))
+
+
+def band_stats(pixels, width, start, end):
+    # the first pass: (colors, runs) of each band of rows start .. end - 1
+    # of pixels, the set of palette indices in the band and the number
+    # of runs of equal pixels in its rows
+    stats = []
+    for y in xrange(start, end, 6):
+        band = pixels[y * width:min(y + 6, end) * width]
+        runs = 0
+        for p in xrange(0, len(band), width):
+            runs += _RUNS.subn(b'', band[p:p + width])[1]
+        stats.append((set(bytearray(band)), runs))
+    return stats
+
+
+def pack_planes(pixels, width, y, band, colors):
+    # {n: body} of the planes of colors in the band of rows y .. y + band
+    # - 1, with the trailing blanks left out. returns the bodies and the
+    # number of runs in them.
+    blank = to_int(b'\x3f' * width)
+    rows = [pixels[p:p + width]
+            for p in xrange(y * width, (y + band) * width, width)]
+    bodies = {}
+    runs = 0
+    for n in colors:
+        plane = 0
+        c = bytes(bytearray([n]))
+        for i, row in enumerate(rows):
+            if c in row:
+                plane |= to_int(row.translate(_table(n, i)))
+        text = to_bytes(plane + blank, width).decode('ascii').rstrip('?')
+        runs += _CHARS.subn('', text)[1]
+        bodies[n] = _REPEATS.sub(_repeat, text)
+    return bodies, runs
+
+
+def join_runs(runs):
+    # the body of a plane from its (six, count) runs
+    parts = []
+    for six, count in runs:
+        if count < 4:
+            parts.append(chr(0x3f + six) * count)
+        else:
+            parts.append('!%d%c' % (count, 0x3f + six))
+    return ''.join(parts)
+
+
+def _join(order, bodies, selected):
+    parts = []
+    for n in order:
+        if parts:
+            parts.append('$')
+        if n != selected:
+            parts.append('#%d' % n)
+            selected = n
+        parts.append(bodies[n])
+    return ''.join(parts), selected
+
+
+def _order(colors, first, following):
+    # colors with first, when it is one of them, at the start and a color
+    # of the following band at the end, so the next band can start
+    # without a color select
+    order = sorted(colors)
+    if first in colors:
+        order.remove(first)
+    last = [n for n in order if n in following]
+    if last:
+        order.remove(last[0])
+        order.append(last[0])
+    if first in colors:
+        order.insert(0, first)
+    return order
+
+
+def arrange(bodies, selected, following, width, band, opaque):
+    # the planes of a band joined in the color orders worth trying, as
+    # (text, selected color at the end, strategy). opaque bands can also
+    # be painted first with one run of a color over the whole band, the
+    # color with the longest body or the one already selected, and the
+    # other planes drawn on top of it.
+    candidates = []
+    if not bodies:
+        return [('', selected, "planes")]
+    text, last = _join(_order(bodies, selected, following), bodies, selected)
+    candidates.append((text, last, "planes"))
+    if opaque:
+        full = chr(0x3f + (1 << band) - 1)
+        if width < 4:
+            full *= width
+        else:
+            full = '!%d%s' % (width, full)
+        fills = [max(sorted(bodies), key=lambda n: len(bodies[n]))]
+        if selected in bodies and selected != fills[0]:
+            fills.append(selected)
+        for fill in fills:
+            filled = dict(bodies)
+            filled[fill] = full
+            rest = [n for n in bodies if n != fill]
+            order = [fill] + _order(rest, None, following)
+            text, last = _join(order, filled, selected)
+            candidates.append((text, last, "fill"))
+    return candidates